@@ -3,9 +3,22 @@ import sys
 from datetime import datetime
 from pathlib import Path
 
+from tasks.managers.utils.import_profiler import ImportProfiler
+
+# python run_training.py --profile-startup: print the import time of every module loaded until the task is ready
+import_profiler = ImportProfiler() if "--profile-startup" in sys.argv else None
+if import_profiler is not None:
+    import_profiler.start()
+
 from tasks.managers.data_io import DataIO
 from tasks.managers.path_manager import PathManager
-from tasks.managers.reader_writers import RotaryRecorder, SyncRecorder, TriggerPulse
+from tasks.managers.session_clock import SessionClock
+from tasks.managers.reader_writers import (
+    RotaryEdgeRecorder,
+    RotaryRecorder,
+    SyncRecorder,
+    TriggerPulse,
+)
 from tasks.managers.utils.utils import plot_behavior_terminal, start_option
 
 task, sync_rec, camera, rotary, exp_dir = None, None, None, None, None
@@ -43,6 +56,8 @@ while True:
 module = __import__(f"tasks.{task_type}", fromlist=[task_class_name])
 TaskClass = getattr(module, task_class_name)
 print(f"Successfully loaded {task_class_name} task.")
+if import_profiler is not None:
+    import_profiler.report()
 
 experimenter = input("who is running the experiment?")
 
@@ -51,6 +66,11 @@ start_time = datetime.now().strftime(hour_format)
 
 path_manager = PathManager((Path(__file__).parent / "..").resolve(), animal_id)
 data_io = DataIO(path_manager, task_type)
+# record every wheel position change with its own timestamp instead of sampling at rotary_rate
+if data_io.load_droid_setting()["base_params"].get("rotary_edge_events", False):
+    RotaryRecorderClass = RotaryEdgeRecorder
+else:
+    RotaryRecorderClass = RotaryRecorder
 
 
 
@@ -61,12 +81,13 @@ while True:
         if not exp_dir:
             animal_dir = path_manager.check_dir()
             exp_dir = path_manager.make_exp_dir()
-        task = TaskClass(data_io, exp_dir, task_type)
-        rotary = RotaryRecorder(path_manager, exp_dir, task_type)
+        session_clock = SessionClock()  # shared by the task and all recorders
+        task = TaskClass(data_io, exp_dir, task_type, session_clock)
+        rotary = RotaryRecorderClass(path_manager, exp_dir, task_type, session_clock)
         if sync_bool:
-            sync_rec = SyncRecorder(path_manager, exp_dir, task_type)
+            sync_rec = SyncRecorder(path_manager, exp_dir, task_type, session_clock)
         if camera_bool:
-            camera = TriggerPulse(path_manager, exp_dir, task_type)
+            camera = TriggerPulse(path_manager, exp_dir, task_type, session_clock)
         task.start()
         rotary.start()
         if sync_bool:
@@ -99,6 +120,7 @@ while True:
             procedure=task_type,
             pre_reversal=task.pre_reversal,
             experimenter=experimenter,
+            camera_stats=camera.getStats() if camera_bool else None,
         )
         # store_reaction_times(exp_dir, task)
         data_io.store_pref_data(exp_dir)
@@ -108,6 +130,13 @@ while True:
             sync_rec.join()
         if camera_bool:
             camera.join()
+        if data_io.load_droid_setting()["base_params"].get("session_container", False):
+            # typed copy of all session streams next to the csv files
+            from tasks.managers.session_container import write_session_container
+
+            write_session_container(
+                exp_dir, path_manager.get_today(), data_io.load_trial_header()
+            )
         plot_behavior_terminal(data_io, exp_dir)  # plot behavior in terminal
         print("ending_criteria: " + ending_criteria)
         sys.exit()
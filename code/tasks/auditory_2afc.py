@@ -19,12 +19,14 @@ Aim:
 
 """
 
-import random
 import time
 
 import numpy as np
-import sounddevice as sd
-from tasks.auditory_2afc_helpers import BiasCorrectionHandler, StageChecker
+from tasks.auditory_2afc_helpers import (
+    BiasCorrectionHandler,
+    OnlinePsychometricEstimator,
+    StageChecker,
+)
 from tasks.base_auditory_task import BaseAuditoryTask
 
 
@@ -46,8 +48,8 @@ class Auditory2AFC(BaseAuditoryTask):
     HIGH_PROB_STAGE_5_BLOCK_POS = 0.8
     NO_BIAS_TRIALS_STAGE_5 = 90
 
-    def __init__(self, data_io, exp_dir, procedure):
-        super().__init__(data_io, exp_dir, procedure)
+    def __init__(self, data_io, exp_dir, procedure, session_clock=None):
+        super().__init__(data_io, exp_dir, procedure, session_clock)
 
         start_time = time.time()
         self.time_out = start_time + self.TIME_LIMIT * self.SECONDS
@@ -80,6 +82,9 @@ class Auditory2AFC(BaseAuditoryTask):
         self.block_length = 0
         self.block_counter = 0
 
+        # live psychometric curve of this session, refitted during the session
+        self.psychometric_estimator = OnlinePsychometricEstimator(self.response_matrix)
+
     def get_trial(self):
         """
         Determine the trial type (high or low tone) based on the current stage and trial number.
@@ -87,21 +92,22 @@ class Auditory2AFC(BaseAuditoryTask):
             str: The trial ID ('high' or 'low').
         """
 
+        rng = self.session_rng.trial
         if self.stage < 5:
-            self.trial_id = "high" if random.random() < self.NO_BIAS_PROB else "low"
+            self.trial_id = "high" if rng.random() < self.NO_BIAS_PROB else "low"
 
         elif self.stage == 5:
             if self.trial_num <= self.NO_BIAS_TRIALS_STAGE_5:
                 if self.trial_num == self.NO_BIAS_TRIALS_STAGE_5:
                     self.get_block()  # Set up the block after first 90 trials
-                self.trial_id = "high" if random.random() < self.NO_BIAS_PROB else "low"
+                self.trial_id = "high" if rng.random() < self.NO_BIAS_PROB else "low"
             else:
                 high_prob = (
                     self.HIGH_PROB_STAGE_5_BLOCK_NEG
                     if self.block == -1
                     else self.HIGH_PROB_STAGE_5_BLOCK_POS
                 )
-                self.trial_id = "high" if random.random() < high_prob else "low"
+                self.trial_id = "high" if rng.random() < high_prob else "low"
 
                 self.block_counter += 1
                 print(f"Block counter: {self.block_counter}")
@@ -153,7 +159,7 @@ class Auditory2AFC(BaseAuditoryTask):
         # open trial data file and read the last 10 trials and calculate the average
         hist_list = self.decision_history[-self.MIN_TRIAL_DEBIAS :]
         hist_mean = np.mean(hist_list)
-        debias_val = random.gauss(hist_mean, self.DECISION_SD)
+        debias_val = self.session_rng.trial.normal(hist_mean, self.DECISION_SD)
         bias_side = "right" if debias_val > 0 else "left"
         tone = list(self.response_matrix.keys())[
             list(self.response_matrix.values()).index(bias_side)
@@ -166,6 +172,10 @@ class Auditory2AFC(BaseAuditoryTask):
 
         # continously stream the wheel_position --> if it crosses threshold (30 degree) mark choice as left/right; otherwise it's "undecided"
         # right turns are positive and left turns are negative --> depends on how you wire the encoder
+        self.wheel_crossing.wait(
+            max(0.0, self.response_timeout - time.time())
+        )  # block until the wheel crossed turning_goal or the response window is over
+        self.wheel_crossing.clear()
         current_position = self.encoder_data.getValue()
         # self.rotary_logger(self.current_position)
         wheel_position = current_position - self.wheel_start_position
@@ -175,7 +185,6 @@ class Auditory2AFC(BaseAuditoryTask):
             self.decision_var = "left"
         else:
             self.decision_var = "undecided"
-        time.sleep(0.001)  # 1 ms sleep, otherwise some threading issue occur
         return self.decision_var
 
     def choice_evaluation(self):  # , trial_id):
@@ -219,7 +228,13 @@ class Auditory2AFC(BaseAuditoryTask):
                 self.ending_criteria = "disengagement"
                 self.stop = True
 
+    def run(self):
+        self.psychometric_estimator.start()
+        super().run()
+        self.psychometric_estimator.close()
+
     def check_stage(self):
+        self.logger.flush()  # trial data of the running session is read back
         self.stage_checker = StageChecker(
             self.data_io,
             self.stage,
@@ -245,21 +260,21 @@ class Auditory2AFC(BaseAuditoryTask):
     def get_block(self):
 
         if self.block == 0:  # first block to be decided
-            self.block = random.choice([-1, 1])
-            self.block_length = random.randrange(30, 70)
+            self.block = self.session_rng.choice(self.session_rng.trial, [-1, 1])
+            self.block_length = int(self.session_rng.trial.integers(30, 70))
             self.block_counter = 0
         else:
             if self.block == -1:
                 self.block = 1
             else:
                 self.block = -1
-            self.block_length = random.randrange(30, 70)
+            self.block_length = int(self.session_rng.trial.integers(30, 70))
             self.block_counter = 0
             print(self.block_length)
 
     def get_log_data(self):
         return "{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10}\n".format(
-            time.time(),
+            self.session_clock.time(),
             str(self.trial_num),
             str(self.trial_start),
             str(self.trial_id),
@@ -301,62 +316,60 @@ class Auditory2AFC(BaseAuditoryTask):
         timeout = (
             time.time() + self.response_window
         )  # start a timer at the size of the response window
+        self.response_timeout = timeout
         self.trial_num += 1
 
-        with sd.OutputStream(
-            samplerate=self.stimulus_manager.fs,
-            blocksize=len(self.cloud),
-            channels=2,
-            dtype="int16",
-            latency="low",
-            callback=self.callback,
-        ):
-            time.sleep(
-                self.stimulus_manager.cloud_duration * 2
-            )  # to avoid zero shot trials, stream buffers 2x the cloud duration before tone onset
-            self.tone_played = 1
-            self.logger.log_trial_data(self.get_log_data())
-            self.tone_played = 0
-            self.wheel_start_position = self.encoder_data.getValue()
-            while True:
-                self.decision_var, self.choice = self.choice_evaluation()
-                if self.choice == "correct":  # if choice was correct
-                    self.cancel_audio = True
-                    self.trial_stat[0] += 1
-                    self.logger.log_trial_data(self.get_log_data())
-                    self.reaction_times.append(time.time() - trial_start)
-                    self.reward_time = 1
-                    pump_time_adjust = self.adjust_pump_duration()
-                    self.logger.log_trial_data(self.get_log_data())
-                    self.reward_system.trigger_reward(self.logger, pump_time_adjust)
-                    self.reward_time = 0
-                    if self.target_position == "right":
-                        self.decision_history.append(1)
-                    else:
-                        self.decision_history.append(-1)
-                    self.correct_hist.append(1)
-                    break
-                elif self.choice == "incorrect":  # if choice was incorrect
-                    self.cancel_audio = True
-                    self.trial_stat[1] += 1
-                    self.logger.log_trial_data(self.get_log_data())
-                    self.reaction_times.append(time.time() - trial_start)
-                    if self.target_position == "right":
-                        self.decision_history.append(-1)
-                    else:
-                        self.decision_history.append(1)
-                    self.correct_hist.append(0)
-                    break
-                elif (
-                    time.time() > timeout
-                ):  # omission trials: no response in response window
-                    self.cancel_audio = True
-                    self.trial_stat[2] += 1
-                    self.logger.log_trial_data(self.get_log_data())
-                    self.reaction_times.append(time.time() - trial_start)
-                    self.decision_history.append(0)
-                    self.correct_hist.append(0)
-                    break
+        self.audio_engine.play_loop(self.cloud)
+        self.tone_played = 1
+        self.tone_onset_time = self.session_clock.time()
+        self.logger.log_trial_data(self.get_log_data())
+        self.tone_played = 0
+        self.wheel_start_position = self.encoder_data.getValue()
+        self.wheel_crossing = self.watch_turning_goal()
+        while True:
+            self.decision_var, self.choice = self.choice_evaluation()
+            if self.choice == "correct":  # if choice was correct
+                self.audio_engine.stop()
+                self.trial_stat[0] += 1
+                self.logger.log_trial_data(self.get_log_data())
+                self.reaction_times.append(time.time() - trial_start)
+                self.reward_time = 1
+                pump_time_adjust = self.adjust_pump_duration()
+                self.logger.log_trial_data(self.get_log_data())
+                self.reward_system.trigger_reward(self.logger, pump_time_adjust)
+                self.reward_time = 0
+                if self.target_position == "right":
+                    self.decision_history.append(1)
+                else:
+                    self.decision_history.append(-1)
+                self.correct_hist.append(1)
+                break
+            elif self.choice == "incorrect":  # if choice was incorrect
+                self.audio_engine.stop()
+                self.trial_stat[1] += 1
+                self.logger.log_trial_data(self.get_log_data())
+                self.reaction_times.append(time.time() - trial_start)
+                if self.target_position == "right":
+                    self.decision_history.append(-1)
+                else:
+                    self.decision_history.append(1)
+                self.correct_hist.append(0)
+                break
+            elif (
+                time.time() > timeout
+            ):  # omission trials: no response in response window
+                self.audio_engine.stop()
+                self.trial_stat[2] += 1
+                self.logger.log_trial_data(self.get_log_data())
+                self.reaction_times.append(time.time() - trial_start)
+                self.decision_history.append(0)
+                self.correct_hist.append(0)
+                break
+        self.encoder_data.unwatch(self.wheel_crossing)
+        self.psychometric_estimator.add_trial(
+            self.trial_id, self.curr_stim_strength, self.decision_var, self.block
+        )
+        self.log_tone_onset()
         if self.choice == "correct":
             self.curr_iti = self.iti[0]
         elif self.choice == "incorrect":
@@ -373,7 +386,7 @@ class Auditory2AFC(BaseAuditoryTask):
             self.curr_iti = self.iti[1]  # if omission, add 1.5 sec punishment timeout
 
         self.last_trial = self.trial_id  # only for stage 0
-        self.cancel_audio = False
+        self.logger.flush()  # write the trial to disk during the ITI
         time.sleep(self.curr_iti)  # inter-trial-interval
         self.logger.log_trial_data(self.get_log_data())
         print(f"trial number: {self.trial_num} - correct trials: {self.trial_stat[0]}")
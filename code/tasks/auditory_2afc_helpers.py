@@ -1,16 +1,19 @@
 import json
 import math
+import threading
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 from tasks.managers.utils.psychofit import (
+    bootstrap_psycho,
     erf_psycho,
     erf_psycho_2gammas,
-    mle_fit_psycho,
+    mle_fit_psycho_fast,
     weibull,
     weibull50,
 )
+from tasks.managers.utils.trial_events import reduce_trial_events
 
 
 class StageChecker:
@@ -36,6 +39,9 @@ class StageChecker:
     SLOPE_CRITERIUM = 19
     GAMMA_CRITERIUM = 0.2
     STAGE_5_BIAS_CRITERIUM = 5
+    N_BOOTSTRAP = 1000  # replicates for the confidence intervals of the stage 4 fit, 0: point estimates only
+    CI_ALPHA = 0.1  # stage 4 criteria have to hold over the whole 90 % confidence interval
+    FIT_SEED = 0  # random starts and bootstrap draws of the stage checks, the same trials give the same decision
 
     def __init__(
         self,
@@ -181,21 +187,37 @@ class StageChecker:
             print("trial number and easy trial performance good")
             trial_data = trial_data.reset_index(drop=True)
             prob_right, num_trials = self._get_performance_per_stim(trial_data)
-            pars, L = mle_fit_psycho(
-                np.vstack(
-                    [
-                        np.array(self.STIM_LIST),
-                        np.array(num_trials),
-                        np.array(prob_right),
-                    ]
-                ),  # 'erf_psycho_2gammas',
+            psycho_data = np.vstack(
+                [
+                    np.array(self.STIM_LIST),
+                    np.array(num_trials),
+                    np.array(prob_right),
+                ]
+            )
+            pars, L = mle_fit_psycho_fast(
+                psycho_data,  # 'erf_psycho_2gammas',
                 P_model=self.P_MODEL,  # weibull # Gauss error function
                 nfits=self.N_FITS,
+                rng=self.FIT_SEED,
             )
 
             (bias, slope, gamma1, gamma2) = pars
+            bias_deviation = abs(bias - self.STAGE_4_BIAS_CENTER)
+            if self.N_BOOTSTRAP:
+                # use the bounds of the confidence intervals, so a noisy fit doesn't advance the stage
+                _, ci, _ = bootstrap_psycho(
+                    psycho_data,
+                    self.P_MODEL,
+                    pars=pars,
+                    n_boot=self.N_BOOTSTRAP,
+                    alpha=self.CI_ALPHA,
+                    rng=self.FIT_SEED,
+                )
+                bias_deviation = np.abs(ci[:, 0] - self.STAGE_4_BIAS_CENTER).max()
+                slope, gamma1, gamma2 = ci[1, 1:]  # upper bounds
+                print(f"psychometric fit: {pars}, confidence intervals: {ci}")
             if (
-                abs(bias - self.STAGE_4_BIAS_CENTER) < self.STAGE_4_BIAS_CRITERIUM
+                bias_deviation < self.STAGE_4_BIAS_CRITERIUM
                 and slope < self.SLOPE_CRITERIUM
                 and gamma1 < self.GAMMA_CRITERIUM
                 and gamma2 < self.GAMMA_CRITERIUM
@@ -268,7 +290,7 @@ class StageChecker:
                 prob_right, num_trials = self._get_performance_per_stim(
                     trial_data, block=block
                 )
-                pars, L = mle_fit_psycho(
+                pars, L = mle_fit_psycho_fast(
                     np.vstack(
                         [
                             np.array(self.STIM_LIST),
@@ -279,6 +301,7 @@ class StageChecker:
                     # 'erf_psycho_2gammas',
                     P_model=self.P_MODEL,  # weibull # Gauss error function
                     nfits=self.N_FITS,
+                    rng=self.FIT_SEED,
                 )
                 if block == -1:
                     bias_stats["bias_low"] = pars[0]
@@ -313,77 +336,73 @@ class StageChecker:
         return self.stage_advance
 
     def _load_trial_data(self, exp_dir, return_start_time=False):
+        # imported here, not at task startup
+        from tasks.managers.session_container import (
+            find_container,
+            load_session_container,
+        )
+
         exp = exp_dir.parts[-2]
-        trial_data_file = exp_dir.joinpath(exp + "_trial_data.csv")
         trial_data_header = self.data_io.load_trial_header()
-        trial_data = pd.read_csv(trial_data_file, names=trial_data_header)
+        container_fn = find_container(exp_dir)
+        if container_fn is not None:  # typed session container, no csv parsing
+            session_data, _ = load_session_container(
+                container_fn, ["trial_data", "tone_onset_data"]
+            )
+            trial_data = session_data["trial_data"]
+            tone_onsets = session_data.get("tone_onset_data")
+        else:
+            trial_data_file = exp_dir.joinpath(exp + "_trial_data.csv")
+            trial_data = pd.read_csv(trial_data_file, names=trial_data_header)
+            tone_onsets = self._load_tone_onsets(exp_dir, exp)
 
         start_time = trial_data["time"][0]
         trial_data["time"] = trial_data["time"] - start_time
         trial_times = self._create_trial_file(trial_data, trial_data_header)
+        if tone_onsets is not None:
+            trial_times = self._replace_tone_onsets(trial_times, tone_onsets, start_time)
         if return_start_time:
             return trial_times, start_time
         else:
             return trial_times
 
-    def _create_trial_file(self, trial_data, trial_data_header):
+    def _load_tone_onsets(self, exp_dir, exp):
+        """
+        Load the tone onsets reported by the audio driver, if these were recorded
+        :param exp_dir: Path
+        :param exp: str
+        :return: tone_onsets: pd.DataFrame or None
+        """
+        from tasks.managers.session_container import STREAMS, read_stream_csv
+
+        suffix, header = STREAMS["tone_onset_data"]
+        return read_stream_csv(exp_dir.joinpath(f"{exp}_{suffix}.csv"), header)
 
-        trial_times = (
-            trial_data[trial_data["trial_start"] == 1][trial_data_header[0:3]]
-            .reset_index()
-            .copy()
-        )  # get first columsn for trial start times etc
-        # get other columns for statistics of that trial columns, not ITT for interval after trial (other columsn are input t+4 for start_idx
-        idx = trial_data.index[
-            trial_data["trial_start"] == 1
-        ].tolist()  # get indices of trial starts
-        idx = idx[1:]  # delete the first value -> info for trial one is in idx=4
-        idx.append(len(trial_data))  # add last entry from file
-        idx = [i - 1 for i in idx]  # substract one to get to matching idx
-        dummy_df = (
-            trial_data.iloc[idx][trial_data_header[3:]].reset_index(drop=True).copy()
+    def _replace_tone_onsets(self, trial_times, tone_onsets, start_time):
+        """
+        Replace the logged tone onsets by the onsets reported by the audio driver, where these were recorded. The
+        onsets are matched by trial number, so a lost onset row only affects its own trial. The trial_num of an onset
+        is the one of its tone_onset row, one more than in the trial_start row of the trial.
+        :param trial_times: pd.DataFrame
+        :param tone_onsets: pd.DataFrame
+        :param start_time: float
+        :return: trial_times: pd.DataFrame
+        """
+        tone_onsets = tone_onsets.drop_duplicates("trial_num")
+        tone_onset_dac = (
+            tone_onsets.set_index("trial_num")["tone_onset_dac"] - start_time
         )
-        trial_times = pd.concat([trial_times, dummy_df], axis=1)
-        if self.TASK_TYPE == "2afc":
-            right_trials = self._get_right_trials()
-            trial_times["stim_strength"] = [
-                int(stim) for stim in trial_times["stim_strength"]
-            ]  # convert to integers from string
-            trial_times.loc[
-                trial_times["trial_type"] != right_trials, "stim_strength"
-            ] = trial_times.loc[
-                trial_times["trial_type"] != right_trials, "stim_strength"
-            ].apply(
-                lambda x: 100 - x
-            )
-        # get time of trial start
         trial_times["tone_onset"] = (
-            trial_data[trial_data["tone_onset"] == 1]["time"]
-            .reset_index(drop=True)
-            .copy()
-        )
-        # get time of reward delivery
-        time_reward = []
-        for i in [id - 1 for id in idx]:  # -1 to get correct reward indices?
-            if (
-                trial_data["choice"][i] == "incorrect"
-                or trial_data["decision"][i] == "no_response"
-            ):
-                time_reward.append(0)
-            else:
-                time_reward.append(trial_data["time"][i])
-        if trial_data["reward_time"].iloc[-2] == 0:
-            time_reward.append(0)
-        else:
-            time_reward.append(trial_data["time"].iloc[-2])
-        trial_times["reward_time"] = pd.DataFrame(time_reward)
-        decision_idx = trial_data[trial_data["tone_onset"] == 1].index + 1
-        trial_times["decision_time"] = (
-            trial_data["time"][decision_idx].reset_index(drop=True).copy()
+            (trial_times["trial_num"] + 1)
+            .map(tone_onset_dac)
+            .fillna(trial_times["tone_onset"])
         )
-
         return trial_times
 
+    def _create_trial_file(self, trial_data, trial_data_header):
+        right_trials = self._get_right_trials() if self.TASK_TYPE == "2afc" else None
+        return reduce_trial_events(trial_data, trial_data_header, right_trials)
+
     def _get_right_trials(self, c_rm=False):
         curr_rm = self.response_matrix["pre_reversal"]
         right_trials = list(curr_rm.keys())[list(curr_rm.values()).index("right")]
@@ -440,9 +459,10 @@ class BiasCorrectionHandler:
         Initialize the BiasCorrectionHandler with the required parameters.
 
         Parameters:
-            animal_dir (Path): Path to the animal's data directory.
+            data_io (DataIO): Data IO of the animal (animal directory, trial header).
             first_day (bool): Flag indicating if it is the first day of training.
         """
+        self.data_io = data_io
         self.animal_dir = data_io.animal_dir
         self.first_day = first_day
         self.bias_correction = False
@@ -492,7 +512,7 @@ class BiasCorrectionHandler:
             trial_data_file = next(last_exp_id.glob("*_trial_data.csv"))
             trial_data_header = self.data_io.load_trial_header()
             trial_data = pd.read_csv(trial_data_file, names=trial_data_header)
-            return trial_data[trial_data["trial_start"] == 1].reset_index()
+            return reduce_trial_events(trial_data, trial_data_header)
         except (IndexError, StopIteration, FileNotFoundError):
             return None
 
@@ -524,3 +544,104 @@ class BiasCorrectionHandler:
 
     def _handle_stage1(self) -> bool:
         return False
+
+
+class OnlinePsychometricEstimator(threading.Thread):
+    REFIT_INTERVAL = 20  # decided trials between refits
+    MIN_LEVELS = 3  # stim levels with trials needed for a fit
+    WAIT_TIMEOUT = 0.5  # sec, how often the thread re-checks the stop flag
+    STIM_LIST = StageChecker.STIM_LIST
+    P_MODEL = StageChecker.P_MODEL
+    N_FITS = StageChecker.N_FITS  # random starts of the first fit of a block, later fits are warm started
+    BLOCKS = [-1, 0, 1]
+    PAR_NAMES = ["bias", "slope", "gamma1", "gamma2"]
+
+    def __init__(self, response_matrix):
+        """
+        Live psychometric fit of the running 2afc session. The task adds every trial to counts of right/left
+        decisions per stim level and block, every REFIT_INTERVAL decided trials the curves are refitted on this
+        thread, warm started from the last fit, so a refit only depends on the number of stim levels.
+
+        Parameters:
+            response_matrix (dict): trial type ('high'/'low') -> side, stim levels are % tones of the 'right' type.
+        """
+        super().__init__(daemon=True)
+        self.right_trials = next(
+            (trial for trial, side in response_matrix.items() if side == "right"),
+            "high",
+        )
+        self.level_index = {stim: i for i, stim in enumerate(self.STIM_LIST)}
+        # [block, stim level, (right, left)] decision counts
+        self.counts = np.zeros((len(self.BLOCKS), len(self.STIM_LIST), 2), dtype=int)
+        self.pars = {}  # block -> np.array of the last fit
+        self.n_decided = 0
+        self.lock = threading.Lock()
+        self.refit_due = threading.Event()
+        self.stop = False
+
+    def add_trial(self, trial_type, stim_strength, decision, block):
+        """
+        :param trial_type: str ('high'/'low')
+        :param stim_strength: int, % tones from the target octave
+        :param decision: str ('left', 'right' or 'undecided', undecided trials are not counted)
+        :param block: int (-1, 0, 1)
+        """
+        if decision not in ("right", "left"):
+            return
+        stim = int(stim_strength)
+        stim = stim if trial_type == self.right_trials else 100 - stim
+        if stim not in self.level_index:
+            return
+        with self.lock:
+            side = 0 if decision == "right" else 1
+            self.counts[self.BLOCKS.index(block), self.level_index[stim], side] += 1
+            self.n_decided += 1
+            if self.n_decided % self.REFIT_INTERVAL == 0:
+                self.refit_due.set()
+
+    def run(self):
+        while not self.stop:
+            if self.refit_due.wait(self.WAIT_TIMEOUT):
+                self.refit_due.clear()
+                self.refit()
+
+    def close(self):
+        self.stop = True
+        if self.is_alive():
+            self.join()
+
+    def refit(self):
+        with self.lock:
+            counts = self.counts.copy()
+        for block, block_counts in zip(self.BLOCKS, counts):
+            num_trials = block_counts.sum(axis=1)
+            if np.count_nonzero(num_trials) < self.MIN_LEVELS:
+                continue
+            with np.errstate(invalid="ignore", divide="ignore"):
+                prob_right = np.where(
+                    num_trials > 0, block_counts[:, 0] / num_trials, np.nan
+                )
+            last_pars = self.pars.get(block)
+            pars, L = mle_fit_psycho_fast(
+                np.vstack([np.array(self.STIM_LIST), num_trials, prob_right]),
+                P_model=self.P_MODEL,
+                parstart=last_pars,
+                nfits=self.N_FITS if last_pars is None else 1,
+            )
+            with self.lock:
+                self.pars[block] = pars
+            print(
+                f"live psychometric fit (block {block}, {num_trials.sum()} trials): "
+                + ", ".join(f"{n}: {v:.2f}" for n, v in zip(self.PAR_NAMES, pars))
+            )
+
+    def get_estimates(self):
+        """
+        Latest live estimates
+        :return: estimates: dict (block -> dict of bias, slope, gamma1, gamma2)
+        """
+        with self.lock:
+            return {
+                block: dict(zip(self.PAR_NAMES, pars.tolist()))
+                for block, pars in self.pars.items()
+            }
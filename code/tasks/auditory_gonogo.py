@@ -19,10 +19,8 @@ Aim:
 
 """
 
-import random
 import time
 
-import sounddevice as sd
 from tasks.base_auditory_task import BaseAuditoryTask
 
 # %%
@@ -39,8 +37,8 @@ class AuditoryGoNoGo(BaseAuditoryTask):
 
     PUMP_TIME_ADJUST = 1  # no intra-trial pump time adjustment
 
-    def __init__(self, data_io, exp_dir, procedure):
-        super().__init__(data_io, exp_dir, procedure)
+    def __init__(self, data_io, exp_dir, procedure, session_clock=None):
+        super().__init__(data_io, exp_dir, procedure, session_clock)
         start_time = time.time()
         self.time_out = start_time + self.TIME_LIMIT * self.SECONDS
         self.time_out_low_trials = (
@@ -66,7 +64,7 @@ class AuditoryGoNoGo(BaseAuditoryTask):
 
     def get_trial(self):
         # randomly choose either high vs. low tone trial
-        if random.random() < 0.5:
+        if self.session_rng.trial.random() < 0.5:
             self.trial_id = "high"
         else:
             self.trial_id = "low"
@@ -84,6 +82,10 @@ class AuditoryGoNoGo(BaseAuditoryTask):
 
         # continously stream the wheel_position --> if it crosses threshold (30 degree) mark choice as left/right; otherwise it's "undecided"
         # right turns are positive and left turns are negative --> depends on how you wire the encoder
+        self.wheel_crossing.wait(
+            max(0.0, timeout - time.time())
+        )  # block until the wheel crossed turning_goal or the response window is over
+        self.wheel_crossing.clear()
         self.current_position = self.encoder_data.getValue()
         # self.rotary_logger(self.current_position)
         self.wheel_position = self.current_position - self.wheel_start_position
@@ -99,7 +101,6 @@ class AuditoryGoNoGo(BaseAuditoryTask):
             self.left_right = "none"
             self.decision_var = "no_response"
             self.choice_hist.append(0)  # one for moved wheel
-        time.sleep(0.001)  # 1 ms sleep, otherwise some threading issue occur
         return self.decision_var
 
     #
@@ -124,7 +125,7 @@ class AuditoryGoNoGo(BaseAuditoryTask):
     def get_log_data(self):
         # always add one line to csv file upon event with timestamp for sync
         return "{0},{1},{2},{3},{4},{5},{6},{7},{8},{9}\n".format(
-            time.time(),
+            self.session_clock.time(),
             str(self.trial_num),
             str(self.trial_start),
             str(self.trial_id),
@@ -158,43 +159,37 @@ class AuditoryGoNoGo(BaseAuditoryTask):
         )  # start a timer at the size of the response window
         self.trial_num += 1
         self.decision_var = False  # set decision variable to False for start of trial, and then in the loop check for decision
-        with sd.OutputStream(
-            samplerate=self.stimulus_manager.fs,
-            blocksize=len(self.cloud),
-            channels=2,
-            dtype="int16",
-            latency="low",
-            callback=self.callback,
-        ):
-            time.sleep(
-                self.stimulus_manager.cloud_duration * 2
-            )  # to avoid zero shot trials, stream buffers 2x the cloud duration before tone onset
-            self.tone_played = 1
-            self.logger.log_trial_data(self.get_log_data())
-            self.tone_played = 0
-            self.wheel_start_position = self.encoder_data.getValue()
-            while True:
-                self.decision_var = self.calculate_decision(
-                    timeout
-                )  # should stay False until either response window is over or animal moved the wheel
-                if self.decision_var == self.target_position:  # if choice was correct
-                    self.cancel_audio = True
-                    self.choice = "correct"
-                    self.trial_stat[0] += 1
-                    self.logger.log_trial_data(self.get_log_data())
-                    if self.decision_var == "moved_wheel":  # reward only in go trials
-                        self.reward_system.trigger_reward(
-                            self.logger, self.PUMP_TIME_ADJUST
-                        )
-                    break
-                elif (
-                    self.decision_var
-                ):  # if choice was incorrect and variable is NOT False, trial was incorrect
-                    self.cancel_audio = True
-                    self.choice = "incorrect"
-                    self.trial_stat[1] += 1
-                    self.logger.log_trial_data(self.get_log_data())
-                    break
+        self.audio_engine.play_loop(self.cloud)
+        self.tone_played = 1
+        self.tone_onset_time = self.session_clock.time()
+        self.logger.log_trial_data(self.get_log_data())
+        self.tone_played = 0
+        self.wheel_start_position = self.encoder_data.getValue()
+        self.wheel_crossing = self.watch_turning_goal()
+        while True:
+            self.decision_var = self.calculate_decision(
+                timeout
+            )  # should stay False until either response window is over or animal moved the wheel
+            if self.decision_var == self.target_position:  # if choice was correct
+                self.audio_engine.stop()
+                self.choice = "correct"
+                self.trial_stat[0] += 1
+                self.logger.log_trial_data(self.get_log_data())
+                if self.decision_var == "moved_wheel":  # reward only in go trials
+                    self.reward_system.trigger_reward(
+                        self.logger, self.PUMP_TIME_ADJUST
+                    )
+                break
+            elif (
+                self.decision_var
+            ):  # if choice was incorrect and variable is NOT False, trial was incorrect
+                self.audio_engine.stop()
+                self.choice = "incorrect"
+                self.trial_stat[1] += 1
+                self.logger.log_trial_data(self.get_log_data())
+                break
+        self.encoder_data.unwatch(self.wheel_crossing)
+        self.log_tone_onset()
         if self.choice == "correct":
             self.curr_iti = self.iti[0]
         else:
@@ -206,7 +201,7 @@ class AuditoryGoNoGo(BaseAuditoryTask):
                 )
             self.curr_iti = self.iti[1]  # if not correct, add 3 sec punishment timeout
 
-        self.cancel_audio = False
+        self.logger.flush()  # write the trial to disk during the ITI
         time.sleep(self.curr_iti)  # inter-trial-interval
         self.logger.log_trial_data(self.get_log_data())
         print(f"trial number: {self.trial_num} - correct trials: {self.trial_stat[0]}")
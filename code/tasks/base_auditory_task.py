@@ -1,12 +1,14 @@
-import random
 import threading
 import time
 
 import numpy as np
 import pandas as pd
-import sounddevice as sd
+from tasks.managers.audio_engine import AudioEngine
+from tasks.managers.cloud_prefetcher import CloudPrefetcher
 from tasks.managers.logger import Logger
 from tasks.managers.reward_system import RewardSystem
+from tasks.managers.session_clock import SessionClock
+from tasks.managers.session_rng import SessionRNG
 from tasks.managers.stimulus_manager import StimulusManager
 from tasks.managers.utils.encoder import Encoder
 
@@ -15,10 +17,13 @@ from tasks.managers.utils.encoder import Encoder
 class BaseAuditoryTask(threading.Thread):
     ENCODER_TO_DEGREE = 1024 / 360
     STAGE_0_TURNING_GOAL_ADJUST = 2
+    CLOUD_PREFETCH_DEPTH = 2  # number of pre-generated clouds per (tgt_octave, stim_strength)
 
-    def __init__(self, data_io, exp_dir, task_type):
+    def __init__(self, data_io, exp_dir, task_type, session_clock=None):
         threading.Thread.__init__(self)
         self.data_io = data_io
+        # clock for all timestamps of the session, shared with the recorders if passed in
+        self.session_clock = session_clock if session_clock is not None else SessionClock()
         self.animal_dir = self.data_io.path_manager.check_dir()
         self.task_type = task_type
 
@@ -35,9 +40,16 @@ class BaseAuditoryTask(threading.Thread):
         self.stop = False
         self.ending_criteria = "manual"
 
+        # random streams of the session, set rng_seed in droid_prefs to replay a session
+        self.session_rng = SessionRNG(self.droid_settings["base_params"].get("rng_seed"))
+
         # Components used by all tasks
         self.stimulus_manager = StimulusManager(
-            self.task_prefs, self.droid_settings, self.data_io, exp_dir
+            self.task_prefs,
+            self.droid_settings,
+            self.data_io,
+            exp_dir,
+            self.session_rng,
         )
 
         self.reward_system = RewardSystem(
@@ -50,9 +62,13 @@ class BaseAuditoryTask(threading.Thread):
         )
 
         self.stim_strength = self.task_prefs["task_prefs"]["stim_strength"]
+        self.stim_options = self.get_stim_options()
+        self.cloud_prefetcher = CloudPrefetcher(
+            self.stimulus_manager, self.get_cloud_keys(), self.CLOUD_PREFETCH_DEPTH
+        )
+        self.audio_engine = AudioEngine(self.stimulus_manager.fs, self.session_clock)
         self.cloud = []
         self.cloud_bool = False
-        self.cancel_audio = False
         # punishment sound info
         self.punish_sound = self.task_prefs["task_prefs"]["punishment_sound"]
         self.punish_duration = self.task_prefs["task_prefs"][
@@ -90,14 +106,14 @@ class BaseAuditoryTask(threading.Thread):
         )  # jitter of allowed movements (input from json in degree; then converted into encoder range)
         self.animal_quiet = True
 
-        self.logger = Logger(self.data_io, self.exp_dir)
+        self.logger = Logger(self.data_io, self.exp_dir, self.session_clock)
 
         # data logging
         self.trial_data_fn = exp_dir.joinpath(
             f"{self.data_io.path_manager.get_today()}_trial_data.csv"
         )
         self.tone_cloud_fn = exp_dir.joinpath(
-            f"{self.data_io.path_manager.get_today()}_tone_cloud_data.csv"
+            f"{self.data_io.path_manager.get_today()}_tone_cloud_data.bin"
         )
         self.trial_num = 0
         self.trial_stat = [0, 0, 0]  # number of [correct, incorrect, omission] trials
@@ -105,6 +121,9 @@ class BaseAuditoryTask(threading.Thread):
         self.trial_id = 0
 
         self.tone_played = 0
+        self.tone_onset_time = 0  # wall-clock time of the tone_onset row of the current trial
+        self.wheel_crossing = None  # event set when the wheel crosses turning_goal
+        self.response_timeout = 0  # end of the response window of the current trial
         self.decision_var = 0
         self.choice = 0
         self.reward_time = 0
@@ -171,12 +190,12 @@ class BaseAuditoryTask(threading.Thread):
         print(f"Stage: {stage}")
         return stage
 
-    def get_target_cloud(self):
+    def get_stim_options(self) -> list:
         """
-        Determine the current stimulus strength based on the stage, and create the corresponding tone cloud.
+        Get the stimulus strengths that can be presented in the current stage.
 
         Returns:
-            The generated tone cloud.
+            list: The stimulus strengths to choose from each trial.
         """
         if self.task_type == "auditory_2afc":
             stage_selector = {
@@ -203,69 +222,100 @@ class BaseAuditoryTask(threading.Thread):
             }
 
             if self.stage in stage_selector:
-                options = stage_selector[self.stage]
-            else:
-                print(
-                    f"Warning: Stage {self.stage} out of range (0-5), defaulting to stage 0"
-                )
-                options = stage_selector[0]  # default to stage 0
+                return stage_selector[self.stage]
+            print(
+                f"Warning: Stage {self.stage} out of range (0-5), defaulting to stage 0"
+            )
+            return stage_selector[0]  # default to stage 0
+        else:
+            return [self.stim_strength[0]]
 
-            self.curr_stim_strength = random.choice(options)
+    def get_cloud_keys(self) -> list:
+        """
+        Get all (tgt_octave, stim_strength) combinations that can be requested in this session.
 
-            tgt_octave = 2 if self.trial_id == "high" else 0
+        Returns:
+            list: The cloud types to prefetch, the prefetcher is not started if empty.
+        """
+        if self.task_type in ["auditory_2afc", "auditory_gonogo"]:
+            tgt_octaves = [0, 2]  # low and high trials
+        else:
+            tgt_octaves = [1]
+        return [
+            (tgt_octave, stim_strength)
+            for tgt_octave in tgt_octaves
+            for stim_strength in self.stim_options
+        ]
 
-            self.cloud = self.stimulus_manager.create_tone_cloud(
-                tgt_octave, self.curr_stim_strength
-            )
+    def get_target_cloud(self):
+        """
+        Determine the current stimulus strength based on the stage, and take the corresponding pre-generated tone cloud.
 
-            return self.cloud
+        Returns:
+            The generated tone cloud.
+        """
+        if self.task_type == "auditory_2afc":
+            self.curr_stim_strength = self.session_rng.choice(
+                self.session_rng.trial, self.stim_options
+            )
+            curr_stim_strength = self.curr_stim_strength
+            tgt_octave = 2 if self.trial_id == "high" else 0
         else:
-            curr_stim_strength = self.stim_strength[0]
+            curr_stim_strength = self.stim_options[0]
             if self.task_type == "auditory_gonogo":
                 tgt_octave = 2 if self.trial_id == "high" else 0
             else:
                 tgt_octave = 1
-            self.cloud = self.stimulus_manager.create_tone_cloud(
-                tgt_octave, curr_stim_strength
-            )
 
-            return self.cloud
+        self.cloud, tone_idx = self.cloud_prefetcher.get_cloud(
+            tgt_octave, curr_stim_strength
+        )
+        self.stimulus_manager.log_tone_cloud(tone_idx)
+        return self.cloud
 
     def check_quiet_window(self):
 
         start_pos = self.encoder_data.getValue()  # start position of the wheel
-        q_w = self.quiet_window[0] + np.random.exponential(self.quiet_window[1])
+        q_w = self.quiet_window[0] + self.session_rng.timing.exponential(
+            self.quiet_window[1]
+        )
         if q_w > 1.5:
             q_w = 1.5
         quite_time = time.time() + q_w
-        while True:
-            curr_pos = self.encoder_data.getValue()
-            if not self.cloud_bool:
-                self.cloud = self.get_target_cloud()
-                self.cloud_bool = True
-            if curr_pos not in range(
-                start_pos - self.quite_jitter, start_pos + self.quite_jitter
-            ):  # the curr_pos of the wheel is out of allowed range, exit and checker function will be called again
-                self.animal_quiet = False
-                break
-            elif (
-                time.time() > quite_time
-            ):  # if animal is still for QW, bool to True and exit --> trial will be initialized
-                self.animal_quiet = True
-                break
-            time.sleep(0.001)  # 1 ms sleep, otherwise some threading issue occur
+        wheel_moved = self.encoder_data.watch(
+            start_pos - self.quite_jitter, start_pos + self.quite_jitter - 1
+        )  # set once the wheel leaves the allowed range
+        if not self.cloud_bool:
+            self.cloud = self.get_target_cloud()
+            self.cloud_bool = True
+        # block until the wheel moved (exit and checker function will be called again) or the animal was still
+        # for the QW --> trial will be initialized
+        self.animal_quiet = not wheel_moved.wait(max(0.0, quite_time - time.time()))
+        self.encoder_data.unwatch(wheel_moved)
         return self.animal_quiet, self.cloud
 
+    def watch_turning_goal(self):
+        """
+        Get an event that is set once the wheel is turned beyond turning_goal from wheel_start_position.
+
+        Returns:
+            threading.Event: The crossing event, remove it with encoder_data.unwatch once the decision is made.
+        """
+        return self.encoder_data.watch(
+            self.wheel_start_position - self.turning_goal,
+            self.wheel_start_position + self.turning_goal,
+        )
+
     def play_tone(self, tone, duration, amplitude):
-        audio = self.stimulus_manager.create_tone(int(tone), duration, amplitude)
+        audio = self.stimulus_manager.get_tone(int(tone), duration, amplitude)
         # print(str(tone))
-        sd.play(audio, self.stimulus_manager.fs, blocking=True)
+        self.audio_engine.play(audio, blocking=True)
 
-    def callback(self, outdata, frames, time, status):
-        # callback function for audio stream
-        if self.cancel_audio:
-            raise sd.CallbackStop()
-        outdata[:] = np.column_stack((self.cloud, self.cloud))  # two channels
+    def log_tone_onset(self):
+        # log the tone onset reported by the audio driver next to the wall-clock onset of the tone_onset row
+        self.logger.log_tone_onset(
+            self.trial_num, self.tone_onset_time, self.audio_engine.loop_onset
+        )
 
     def check_disengage(self, criteria_variable):
         if self.task_type == "auditory_2afc":
@@ -293,8 +343,18 @@ class BaseAuditoryTask(threading.Thread):
         return self.disengage
 
     def run(self):
+        prefetch = bool(self.cloud_prefetcher.cloud_queues)  # no cloud types, no thread
+        if prefetch:
+            self.cloud_prefetcher.fill()  # clouds of the first trials, before the producer starts
+            self.cloud_prefetcher.start()
+        self.audio_engine.start()
         while not self.stop:
             self.execute_task()
+        self.audio_engine.close()
+        if prefetch:
+            self.cloud_prefetcher.stop = True
+        self.logger.close()
+        self.stimulus_manager.tone_cloud_log.close()
 
     def execute_task(self):
         raise NotImplementedError("This method should be implemented by subclasses.")
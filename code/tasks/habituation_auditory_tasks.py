@@ -9,10 +9,8 @@ Aim:
 
 """
 
-import random
 import time
 
-import sounddevice as sd
 from base_auditory_task import BaseAuditoryTask
 
 
@@ -41,10 +39,14 @@ class Habituation(BaseAuditoryTask):
             iti_duration + (iti_duration / 2),
         ]  # mean of ITI will be iti_duration
 
+    def get_cloud_keys(self):
+        # clouds are created on the task thread during the trial, nothing to prefetch
+        return []
+
     def get_trial(self):
         if self.task_id == "2afc":
             # randomly choose either high vs. low tone trial
-            if random.random() < 0.5:
+            if self.session_rng.trial.random() < 0.5:
                 self.trial_id = "high"
                 self.tgt_octave = 2
             else:
@@ -57,7 +59,7 @@ class Habituation(BaseAuditoryTask):
 
     def get_log_data(self):
         return "{0},{1},{2},{3},{4},{5},{6}\n".format(
-            time.time(),
+            self.session_clock.time(),
             str(self.trial_num),
             str(self.trial_start),
             str(self.trial_id),
@@ -84,25 +86,18 @@ class Habituation(BaseAuditoryTask):
         )
 
         timeout = time.time() + self.pump_time_after_audio
-        with sd.OutputStream(
-            samplerate=self.stimulus_manager.fs,
-            blocksize=len(self.cloud),
-            channels=2,
-            dtype="int16",
-            latency="low",
-            callback=self.callback,
-        ):
-            while True:
-                if (
-                    time.time() > timeout
-                ):  # omission trials: no response in response window
-                    self.cancel_audio = True
-                    self.reward_system.trigger_reward(
-                        self.logger, self.PUMP_TIME_ADJUST
-                    )
-                    break
-        self.cancel_audio = False
-        self.curr_iti = random.uniform(self.iti[0], self.iti[1])
+        self.audio_engine.play_loop(self.cloud)
+        while True:
+            if (
+                time.time() > timeout
+            ):  # omission trials: no response in response window
+                self.audio_engine.stop()
+                self.reward_system.trigger_reward(
+                    self.logger, self.PUMP_TIME_ADJUST
+                )
+                break
+        self.curr_iti = self.session_rng.timing.uniform(self.iti[0], self.iti[1])
+        self.logger.flush()  # write the trial to disk during the ITI
         time.sleep(self.curr_iti)  # inter-trial-interval
         self.logger.log_trial_data(self.get_log_data())
         print("\ntrial number: ", self.trial_num, end="")
@@ -0,0 +1,182 @@
+import time
+
+import numpy as np
+import sounddevice as sd
+from tasks.managers.session_clock import SessionClock
+
+
+# Audio engine owning one output stream for the whole session
+class AudioEngine:
+    CHANNELS = 2
+    BLOCKSIZE = 512  # frames per callback, fixed delay of play_loop/stop (~12 ms at 44.1 kHz)
+    BUFFER_DURATION = 2  # sec of one-shot sounds the ring buffer can hold
+    WAIT_INTERVAL = 0.001  # sec, polling interval while waiting for buffer space/playback
+
+    def __init__(self, fs, session_clock=None):
+        """
+        Persistent audio output: one-shot sounds (e.g. punishment noise) are queued into a ring buffer, looping
+        sounds (tone clouds) are repeated while the ring buffer is empty until stop() is called.
+
+        play_loop() and stop() take effect sample-accurately one block (BLOCKSIZE frames) after the call: the
+        callback switches the loop at the frame offset of the request instead of at the next block boundary, so the
+        delay between the call and the output does not jitter with the block phase.
+
+        The ring buffer is lock-free: write_idx is only advanced by the task thread, read_idx only by the audio
+        callback (both count frames since the start of the session).
+
+        Parameters:
+            fs (int): Sampling rate of the stream.
+            session_clock (SessionClock): Clock the onset times are reported in.
+        """
+        self.fs = fs
+        self.session_clock = session_clock if session_clock is not None else SessionClock()
+        self.ring = np.zeros(
+            (int(self.BUFFER_DURATION * fs), self.CHANNELS), dtype=np.int16
+        )
+        self.write_idx = 0
+        self.read_idx = 0
+        self.flush_idx = 0  # everything written before this index is dropped by the callback
+        self.loop = (None, 0.0)  # (sound repeated while the ring buffer is empty, session time of the request)
+        self.curr_loop = self.loop  # loop request currently played by the callback
+        self.loop_pos = 0
+        self.loop_onset = None  # session clock time at which the current loop reached the DAC
+        self.stream = sd.OutputStream(
+            samplerate=fs,
+            blocksize=self.BLOCKSIZE,
+            channels=self.CHANNELS,
+            dtype="int16",
+            latency="low",
+            callback=self.callback,
+        )
+
+    def start(self):
+        self.stream.start()
+
+    def close(self):
+        self.stream.stop()
+        self.stream.close()
+
+    def to_stereo(self, sound):
+        """Return sound as a contiguous [samples, 2] int16 array, stereo sounds are passed on without a copy."""
+        sound = np.asarray(sound, dtype=np.int16)
+        if sound.ndim == 2 and sound.shape[1] == self.CHANNELS:
+            return np.ascontiguousarray(sound)
+        sound = sound.reshape(-1)
+        return np.column_stack((sound, sound))  # two channels
+
+    def play(self, sound, blocking=False):
+        """
+        Queue a one-shot sound, it starts right after everything queued before it.
+
+        Parameters:
+            sound (np.array): Mono or stereo int16 sound.
+            blocking (bool): Wait until the sound has been played.
+        """
+        sound = self.to_stereo(sound)
+        size = len(self.ring)
+        written = 0
+        while written < len(sound):
+            free = size - (self.write_idx - self.read_idx)
+            if free == 0:
+                time.sleep(self.WAIT_INTERVAL)
+                continue
+            n = min(free, len(sound) - written)
+            start = self.write_idx % size
+            first = min(n, size - start)
+            self.ring[start : start + first] = sound[written : written + first]
+            self.ring[: n - first] = sound[written + first : written + n]
+            self.write_idx += n  # publish the frames to the callback
+            written += n
+        if blocking:
+            end_idx = self.write_idx
+            while self.read_idx < end_idx and self.flush_idx < end_idx:
+                time.sleep(self.WAIT_INTERVAL)
+
+    def play_loop(self, sound):
+        """
+        Repeat a sound (e.g. a tone cloud) one audio block after the call, until stop() is called. Every call starts
+        the sound from its beginning, also when the same sound is played again.
+
+        Parameters:
+            sound (np.array): Mono or stereo int16 sound, stereo [samples, 2] sounds are played without a copy.
+        """
+        self.loop_onset = None
+        # a new tuple per request, published to the callback in one assignment
+        self.loop = (self.to_stereo(sound), self.session_clock.time())
+
+    def stop(self):
+        """
+        Stop the looping sound one audio block after the call, queued one-shot sounds are dropped from the next
+        audio block on.
+        """
+        self.loop = (None, self.session_clock.time())
+        self.flush_idx = self.write_idx
+
+    def get_onset_time(self, time_info, offset):
+        """
+        Time at which frame `offset` of the current audio block is output by the DAC, mapped from the PortAudio
+        stream clock onto the session clock (the clock of the trial data and the recorders).
+
+        Parameters:
+            time_info: Time info passed to the callback by PortAudio.
+            offset (int): Frame index within the current block.
+        Returns:
+            float: Onset time.
+        """
+        now = self.session_clock.time()
+        if time_info.outputBufferDacTime > 0:
+            dac_delay = time_info.outputBufferDacTime - time_info.currentTime
+        else:  # some host APIs (e.g. ALSA) do not report stream times, use the nominal output latency
+            dac_delay = self.stream.latency
+        return now + dac_delay + offset / self.fs
+
+    def get_request_offset(self, request_time, frames):
+        """
+        Frame of the current block at which a play_loop/stop request takes effect: one block after the request, the
+        callbacks run once per block, so the offset is within the block unless the callback was late.
+
+        Parameters:
+            request_time (float): Session clock time of the request.
+            frames (int): Number of frames in the current block.
+        Returns:
+            int: Frame offset in [0, frames].
+        """
+        offset = frames + round((request_time - self.session_clock.time()) * self.fs)
+        return min(max(offset, 0), frames)
+
+    def fill_loop(self, outdata, start, end):
+        # continue the current loop (or silence) in outdata[start:end]
+        loop = self.curr_loop[0]
+        if loop is None:
+            outdata[start:end].fill(0)
+            return
+        while start < end:
+            k = min(end - start, len(loop) - self.loop_pos)
+            np.copyto(
+                outdata[start : start + k], loop[self.loop_pos : self.loop_pos + k]
+            )
+            start += k
+            self.loop_pos = (self.loop_pos + k) % len(loop)
+
+    def callback(self, outdata, frames, time_info, status):
+        # callback function for audio stream, only copies pre-interleaved int16 frames into outdata
+        size = len(self.ring)
+        if self.flush_idx > self.read_idx:
+            self.read_idx = self.flush_idx
+        n = min(frames, self.write_idx - self.read_idx)
+        start = self.read_idx % size
+        first = min(n, size - start)
+        np.copyto(outdata[:first], self.ring[start : start + first])
+        np.copyto(outdata[first:n], self.ring[: n - first])
+        self.read_idx += n
+
+        request = self.loop
+        if request is not self.curr_loop:  # new loop (or stop), switch at the frame of the request
+            offset = max(self.get_request_offset(request[1], frames), n)
+            self.fill_loop(outdata, n, offset)  # previous loop up to the switch
+            self.curr_loop = request
+            self.loop_pos = 0
+            if request[0] is not None:
+                self.loop_onset = self.get_onset_time(time_info, offset)
+            n = offset
+        self.fill_loop(outdata, n, frames)
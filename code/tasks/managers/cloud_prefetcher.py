@@ -0,0 +1,71 @@
+import queue
+import threading
+
+
+# Producer thread that pre-generates tone clouds, so that cloud synthesis is off the trial-critical path
+class CloudPrefetcher(threading.Thread):
+    WAIT_TIMEOUT = 0.1  # sec, how often the stop flag (producer) or a dead producer (get_cloud) is checked
+
+    def __init__(self, stimulus_manager, cloud_keys, depth):
+        """
+        Keep a bounded queue of pre-generated tone clouds for every cloud type of the session.
+
+        Parameters:
+            stimulus_manager (StimulusManager): Used to generate the clouds.
+            cloud_keys (list): (tgt_octave, stim_strength) tuples that can be requested in this session.
+            depth (int): Number of clouds kept ready per cloud type.
+        """
+        super().__init__(daemon=True)
+        self.stimulus_manager = stimulus_manager
+        self.cloud_queues = {key: queue.Queue(maxsize=depth) for key in cloud_keys}
+        self.cloud_consumed = threading.Event()
+        self.stop = False
+
+    def fill(self):
+        """
+        Fill all queues on the calling thread, call before start() so the first trials do not wait for the producer.
+        """
+        for (tgt_octave, stim_strength), cloud_queue in self.cloud_queues.items():
+            while not cloud_queue.full():
+                cloud_queue.put(
+                    self.stimulus_manager.generate_tone_cloud(tgt_octave, stim_strength)
+                )
+
+    def run(self):
+        while not self.stop:
+            self.cloud_consumed.clear()
+            produced = False
+            for (tgt_octave, stim_strength), cloud_queue in self.cloud_queues.items():
+                if self.stop:
+                    break
+                if not cloud_queue.full():  # only this thread puts, so put() never blocks
+                    cloud_queue.put(
+                        self.stimulus_manager.generate_tone_cloud(
+                            tgt_octave, stim_strength
+                        )
+                    )
+                    produced = True
+            if not produced:  # all queues are full, wait until a cloud is taken
+                self.cloud_consumed.wait(self.WAIT_TIMEOUT)
+
+    def get_cloud(self, tgt_octave, stim_strength):
+        """
+        Take the next cloud of the requested type, waits for the producer if none is ready. Clouds of a prefetched
+        type are only ever generated by the producer (or fill()), so the n-th cloud of a type does not depend on
+        the timing of the trials. Types that are not prefetched are generated in place.
+
+        Returns:
+            tuple: (tone_cloud, tone_idx) as returned by StimulusManager.generate_tone_cloud.
+        """
+        cloud_queue = self.cloud_queues.get((tgt_octave, stim_strength))
+        if cloud_queue is None:
+            return self.stimulus_manager.generate_tone_cloud(tgt_octave, stim_strength)
+        try:
+            while True:
+                try:
+                    return cloud_queue.get(timeout=self.WAIT_TIMEOUT)
+                except queue.Empty:
+                    if not self.is_alive():
+                        raise RuntimeError("cloud prefetcher is not running")
+        finally:
+            self.cloud_consumed.set()
@@ -151,8 +151,12 @@ class DataIO:
         pre_reversal="not specified",
         habi_day=None,
         experimenter="not specified",
+        camera_stats=None,
     ):
         """Store metadata for the session in a JSON file."""
+        encoder = getattr(task_obj, "encoder_data", None)
+        session_clock = getattr(task_obj, "session_clock", None)
+        session_rng = getattr(task_obj, "session_rng", None)
         meta_data = {
             "animal_id": self.animal_dir.stem,
             "droid": droid,
@@ -166,6 +170,20 @@ class DataIO:
             "# trials": getattr(task_obj, "trial_num", "not specified"),
             "pump_duration": int(getattr(task_obj, "pump_duration", 0)),
             "ITI_range": getattr(task_obj, "iti", "not specified"),
+            "encoder_stats": (
+                encoder.getStats() if encoder is not None else "not specified"
+            ),
+            "session_clock_anchor": (
+                session_clock.get_anchor()
+                if session_clock is not None
+                else "not specified"
+            ),
+            "rng_seed": (
+                session_rng.seed if session_rng is not None else "not specified"
+            ),
+            "camera_trigger_stats": (
+                camera_stats if camera_stats is not None else "not specified"
+            ),
         }
 
         # Update metadata based on procedure type
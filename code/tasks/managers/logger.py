@@ -1,21 +1,98 @@
-import time
+import queue
+import threading
+
+from tasks.managers.session_clock import SessionClock
 
 
 # Logger class for logging experimental data
 class Logger:
-    def __init__(self, data_io, exp_dir):
+    QUEUE_SIZE = 1024  # pending lines, log calls only block if the writer thread falls this far behind
+    FLUSH = "flush"
+    CLOSE = "close"
+    TONE_ONSET_HEADER = ["trial_num", "tone_onset", "tone_onset_dac"]
+
+    def __init__(self, data_io, exp_dir, session_clock=None):
+        """
+        Lines are handed to a background writer thread, which keeps the files open for the whole session, so the
+        log calls in the decision/reward path do not wait for the filesystem. Call flush() where the data has to
+        be on disk (ITI, stage check) and close() at the end of the session. Write errors are printed and kept in
+        self.error, the writer thread keeps draining the queue.
+        """
         self.exp_dir = exp_dir
+        self.session_clock = session_clock if session_clock is not None else SessionClock()
         self.trial_data_fn = exp_dir.joinpath(
             f"{data_io.path_manager.get_today()}_trial_data.csv"
         )
         self.pump_log = exp_dir.joinpath(
             f"{data_io.path_manager.get_today()}_pump_data.csv"
         )
+        self.tone_onset_fn = exp_dir.joinpath(
+            f"{data_io.path_manager.get_today()}_tone_onset_data.csv"
+        )
+        self.files = {}  # fn -> handle, opened in append mode on first write
+        # header rows, written when the file is created (the trial data header is task dependent, see DataIO)
+        self.headers = {self.tone_onset_fn: ",".join(self.TONE_ONSET_HEADER) + "\n"}
+        self.write_queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.lock = threading.Lock()  # orders flush() and close(), no FLUSH is queued after CLOSE
+        self.closed = False
+        self.error = None  # last error of the writer thread
+        self.writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def _write_loop(self):
+        while True:
+            fn, line = self.write_queue.get()
+            try:
+                if fn == self.FLUSH or fn == self.CLOSE:
+                    for log in list(self.files.values()):
+                        log.flush()
+                        if fn == self.CLOSE:
+                            log.close()
+                else:
+                    if fn not in self.files:
+                        self.files[fn] = open(fn, "a")
+                        if fn in self.headers and self.files[fn].tell() == 0:  # new file
+                            self.files[fn].write(self.headers[fn])
+                    self.files[fn].write(line)
+            except Exception as e:  # keep draining, a dead writer would block all log calls once the queue is full
+                self.files.pop(fn, None)  # reopened with the next line
+                if self.error is None or str(e) != str(self.error):
+                    print(f"Warning: logger could not write {fn}: {e}")
+                self.error = e
+            finally:
+                self.write_queue.task_done()
+            if fn == self.CLOSE:
+                self.files = {}
+                return
+
+    def put(self, fn, line):
+        if not self.closed:  # nobody drains the queue after close
+            self.write_queue.put((fn, line))
+
+    def flush(self):
+        """Block until all queued lines are written to disk, no-op after close()"""
+        with self.lock:
+            if self.closed:
+                return
+            self.write_queue.put((self.FLUSH, None))
+        self.write_queue.join()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.write_queue.put((self.CLOSE, None))
+        self.writer_thread.join()
 
     def log_trial_data(self, trial_info):
-        with open(self.trial_data_fn, "a") as log:
-            log.write(trial_info)
+        self.put(self.trial_data_fn, trial_info)
 
     def log_pump_data(self, pump_duration):
-        with open(self.pump_log, "a") as log:
-            log.write(f"{time.time()},{pump_duration}\n")
+        self.put(self.pump_log, f"{self.session_clock.time()},{pump_duration}\n")
+
+    def log_tone_onset(self, trial_num, tone_onset, tone_onset_dac):
+        # trial_num: as in the tone_onset row of the trial data (one more than in its trial_start row)
+        # tone_onset: time the tone_onset row was logged, tone_onset_dac: onset reported by the audio driver
+        tone_onset_dac = "" if tone_onset_dac is None else tone_onset_dac
+        self.put(self.tone_onset_fn, f"{trial_num},{tone_onset},{tone_onset_dac}\n")
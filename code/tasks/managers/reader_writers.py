@@ -1,38 +1,49 @@
 import threading
 import time
-import csv
 
 import RPi.GPIO as GPIO
 from tasks.managers.data_io import DataIO
+from tasks.managers.session_clock import SessionClock
+from tasks.managers.utils.batch_writer import BatchWriter
+from tasks.managers.utils.camera_trigger import PigpioTrigger
 from tasks.managers.utils.encoder import Encoder
 from tasks.managers.utils.sync_pulse import Sync_Pulse
 
 
 class BaseRecorder(threading.Thread):
-    def __init__(self, path_manager, exp_dir, task_type, file_name_suffix, rate_key):
+    FLUSH_SIZE = 512  # samples per batch written to disk
+    FLUSH_INTERVAL = 1.0  # sec, max. time a sample is held in memory
+
+    def __init__(
+        self,
+        path_manager,
+        exp_dir,
+        task_type,
+        file_name_suffix,
+        rate_key,
+        session_clock=None,
+    ):
         super().__init__()
+        self.session_clock = session_clock if session_clock is not None else SessionClock()
         data_io = DataIO(path_manager, task_type)
         self.droid_settings = data_io.load_droid_setting()
         self.rate = self.droid_settings["base_params"][rate_key]
 
         self.fn = exp_dir.joinpath(f"{path_manager.get_today()}_{file_name_suffix}.csv")
-        self.file = open(self.fn, mode='w', newline='')
-        self.writer = csv.writer(self.file)
-        self.writer.writerow(["timestamp", "value"])  # CSV header
+        self.batch_writer = BatchWriter(
+            self.fn, ["timestamp", "value"], self.FLUSH_SIZE, self.FLUSH_INTERVAL
+        )
 
         self.stop = False
 
     def write_data(self, data):
-        """Writes data to the file."""
-        # with open(self.fn, "a") as log:
-        #     log.write(f"{time.time()},{data}\n")
-        self.writer.writerow([time.time(), data])
-        self.file.flush()  # Ensure data is written immediately
+        """Writes data to the file (batched, see BatchWriter)."""
+        self.batch_writer.write(self.session_clock.time(), data)
 
     def run(self):
         while not self.stop:
             self.record()
-        self.file.close()
+        self.batch_writer.close()
 
     def record(self):
         """This method should be implemented by subclasses."""
@@ -40,52 +51,166 @@ class BaseRecorder(threading.Thread):
 
 
 class TriggerPulse(BaseRecorder):
-    def __init__(self, path_manager, exp_dir, task_type):
+    STOP_POLL_INTERVAL = 0.1  # sec, how often the pigpio backend checks for stop
+
+    def __init__(self, path_manager, exp_dir, task_type, session_clock=None):
         super().__init__(
             path_manager,
             exp_dir,
             task_type,
             file_name_suffix="camera_pulse_data",
             rate_key="camera_trigger_rate",
+            session_clock=session_clock,
         )
         self.trigger_pin = self.droid_settings["pin_map"]["OUT"]["trigger_camera"]
         self.trigger_state = 0
-        GPIO.setwarnings(False)
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.trigger_pin, GPIO.OUT)
+        self.period_ns = round(1e9 / self.rate)
+        self.deadline = None  # time.monotonic_ns() of the next rising edge
+        # period statistics of the rising edges
+        self.first_rise = None
+        self.last_rise = None
+        self.rise_count = 0
+        self.period_sum = 0.0
+        self.period_sq_sum = 0.0
+        self.max_lateness = 0
+        self.skipped_count = 0  # frames dropped because the thread fell behind by more than a period
+
+        self.hardware_trigger = None
+        backend = self.droid_settings["base_params"].get("camera_trigger_backend", "gpio")
+        if backend == "pigpio":
+            try:
+                self.hardware_trigger = PigpioTrigger(
+                    self.trigger_pin,
+                    self.rate,
+                    self.hardware_edge,
+                    clock=self.session_clock.time,
+                )
+            except (ImportError, RuntimeError) as e:
+                print(f"Warning: {e} -- falling back to software camera trigger.")
+        if self.hardware_trigger is None:
+            GPIO.setwarnings(False)
+            GPIO.setmode(GPIO.BCM)
+            GPIO.setup(self.trigger_pin, GPIO.OUT)
+
+    def wait_until(self, deadline):
+        delay = deadline - time.monotonic_ns()
+        if delay > 0:
+            time.sleep(delay / 1e9)
+
+    def record_rise(self, rise_time, deadline):
+        """Update the period statistics with a rising edge at rise_time, scheduled for deadline (both ns)."""
+        if self.last_rise is None:
+            self.first_rise = rise_time
+        else:
+            period = rise_time - self.last_rise
+            self.period_sum += period
+            self.period_sq_sum += period**2
+        self.last_rise = rise_time
+        self.rise_count += 1
+        self.max_lateness = max(self.max_lateness, rise_time - deadline)
 
     def pull_trigger(self):
+        # edges are scheduled on absolute deadlines, so late wake-ups do not add up to a lower frame rate
+        now = time.monotonic_ns()
+        if self.deadline is None:
+            self.deadline = now
+        elif now - self.deadline > self.period_ns:  # fell behind, skip the frames instead of sending a burst
+            skipped = (now - self.deadline) // self.period_ns
+            self.skipped_count += skipped
+            self.deadline += skipped * self.period_ns
+        self.wait_until(self.deadline)
         self.trigger_state = 1
-        self.write_data(self.trigger_state)  # todo move one line down
         GPIO.output(self.trigger_pin, self.trigger_state)
-        time.sleep(1 / (self.rate / 2))
+        self.record_rise(time.monotonic_ns(), self.deadline)
+        self.write_data(self.trigger_state)
+        self.wait_until(self.deadline + self.period_ns // 2)
         self.trigger_state = 0
         GPIO.output(self.trigger_pin, self.trigger_state)
         self.write_data(self.trigger_state)
-        time.sleep(1 / (self.rate / 2))
+        self.deadline += self.period_ns
+
+    def hardware_edge(self, timestamp, level):
+        # called from the pigpio callback thread, the waveform itself is timed by the pigpio daemon
+        self.batch_writer.write(timestamp, level)
+        if level == 1:
+            rise_time = round(timestamp * 1e9)
+            if self.first_rise is None:
+                deadline = rise_time
+            else:  # nominal schedule of the waveform
+                period_ns = self.hardware_trigger.period_us * 1000
+                deadline = self.first_rise + self.rise_count * period_ns
+            self.record_rise(rise_time, deadline)
+
+    def getStats(self):
+        """
+        Achieved trigger timing, stored in the meta data
+        :return: stats: dict (periods and lateness in ms)
+        """
+        n_periods = max(self.rise_count - 1, 1)
+        mean_period = self.period_sum / n_periods
+        var_period = max(self.period_sq_sum / n_periods - mean_period**2, 0.0)
+        return {
+            "backend": "gpio" if self.hardware_trigger is None else "pigpio",
+            "frames": self.rise_count,
+            "target_period_ms": 1e3 / self.rate,
+            "mean_period_ms": mean_period / 1e6,
+            "std_period_ms": var_period**0.5 / 1e6,
+            "max_lateness_ms": self.max_lateness / 1e6,
+            "skipped_frames": self.skipped_count,
+        }
+
+    def run(self):
+        if self.hardware_trigger is None:
+            super().run()
+            return
+        self.hardware_trigger.start()
+        while not self.stop:
+            time.sleep(self.STOP_POLL_INTERVAL)
+        self.hardware_trigger.stop()
+        self.batch_writer.close()
 
     def record(self):
         self.pull_trigger()
 
 
 class RotaryRecorder(BaseRecorder):
-    def __init__(self, path_manager, exp_dir, task_type):
+    EDGE_BUFFER_SIZE = 0  # no edge buffer, the encoder value is sampled at rotary_rate
+
+    def __init__(self, path_manager, exp_dir, task_type, session_clock=None):
         super().__init__(
             path_manager,
             exp_dir,
             task_type,
             file_name_suffix="rotary_data",
             rate_key="rotary_rate",
+            session_clock=session_clock,
         )
         self.encoder_left = self.droid_settings["pin_map"]["IN"]["encoder_left_rec"]
         self.encoder_right = self.droid_settings["pin_map"]["IN"]["encoder_right_rec"]
-        self.encoder_data = Encoder(self.encoder_left, self.encoder_right)
+        self.encoder_data = Encoder(
+            self.encoder_left,
+            self.encoder_right,
+            edge_buffer_size=self.EDGE_BUFFER_SIZE,
+        )
 
     def record(self):
-        wheel_position = str(self.encoder_data.getValue())
+        wheel_position = self.encoder_data.getValue()
         self.write_data(wheel_position)
         time.sleep(1 / self.rate)
 
+
+class RotaryEdgeRecorder(RotaryRecorder):
+    """Records every change of the wheel position with its own timestamp, drained from the encoder at rotary_rate"""
+
+    EDGE_BUFFER_SIZE = 2**16
+
+    def record(self):
+        time.sleep(1 / self.rate)  # drain after sleeping, so the last drain happens after stop
+        edge_times, edge_values = self.encoder_data.drainEdges()
+        if len(edge_times):
+            timestamps = self.session_clock.to_time(edge_times)
+            self.batch_writer.write_many(timestamps, edge_values)
+
 #
 # class SyncRecorder(BaseRecorder):
 #     def __init__(self, path_manager, exp_dir, task_type):
@@ -141,36 +266,48 @@ class RotaryRecorder(BaseRecorder):
 #             self.writer.writerows(self.sync_pulse_list)
 
 class SyncRecorder(threading.Thread):
-    def __init__(self, path_manager, exp_dir, task_type):
+    CHUNK_SIZE = 4096  # pulses held in memory before they are written to disk
+    SPILL_INTERVAL = 1.0  # sec, collected pulses are written to disk at least this often
+
+    def __init__(self, path_manager, exp_dir, task_type, session_clock=None):
         super().__init__()
+        self.session_clock = session_clock if session_clock is not None else SessionClock()
         data_io = DataIO(path_manager, task_type)
         self.droid_settings = data_io.load_droid_setting()
         self.fn = exp_dir.joinpath(f"{path_manager.get_today()}_sync_pulse_data.csv")
         self.running = False
-        self.file = open(self.fn, mode='w', newline='')
-        self.writer = csv.writer(self.file)
-        self.writer.writerow(["Timestamp", "PinState"])  # CSV header
-        self.sync_pulse_list = []
+        self.batch_writer = BatchWriter(
+            self.fn, ["Timestamp", "PinState"], self.CHUNK_SIZE, self.SPILL_INTERVAL
+        )
 
+        self.stop_event = threading.Event()
         self.stop = False
 
         self.sync_pin = self.droid_settings["pin_map"]["IN"]["microscope_sync"]
         GPIO.setup(self.sync_pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
         # self.sync_pulse = Sync_Pulse(self.sync_pin, callback=self._transition_occurred)
 
+    @property
+    def stop(self):
+        return self.stop_event.is_set()
+
+    @stop.setter
+    def stop(self, value):
+        if value:
+            self.stop_event.set()  # wakes up run()
+        else:
+            self.stop_event.clear()
+
     def run(self):
         GPIO.add_event_detect(self.sync_pin, GPIO.RISING, callback=self._transition_occurred)
-        while not self.stop:
-            pass
-        self.writer.writerows(self.sync_pulse_list)
+        self.stop_event.wait()  # the pulses are spilled to disk by the flusher thread of the batch writer
         GPIO.remove_event_detect(self.sync_pin)  # Remove event detection
-        self.file.close()
+        self.batch_writer.close()
 
     def _transition_occurred(self, pin):
+        # GPIO callback thread, shared with the encoder callbacks: only append, never touch the disk
         if not self.stop:
-            self.sync_pulse_list.append([time.time(), 1])
-            # self.writer.writerow([time.time(), 1])
-            # self.file.flush()  # Ensure data is written immediately
+            self.batch_writer.write(self.session_clock.time(), 1)
 
 
 # class SyncRecorder(threading.Thread):
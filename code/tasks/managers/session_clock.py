@@ -0,0 +1,32 @@
+import time
+
+
+# Clock shared by the task, the logger and all recorders of a session
+class SessionClock:
+    def __init__(self):
+        """
+        Timestamps are time.monotonic_ns() mapped onto wall-clock time through one (time.time(), time.monotonic_ns())
+        anchor taken at the start of the session. All streams are stamped on the same monotonic timebase, so NTP
+        slews during the session do not shift them against each other, and a timestamp t corresponds to
+        monotonic_ns = anchor_ns + round((t - anchor_time) * 1e9).
+        """
+        self.anchor_time = time.time()
+        self.anchor_ns = time.monotonic_ns()
+
+    def now_ns(self):
+        return time.monotonic_ns()
+
+    def to_time(self, t_ns):
+        """
+        Map monotonic_ns timestamps onto the session's wall-clock time
+        :param t_ns: int or np.array (time.monotonic_ns() timestamps)
+        :return: float or np.array
+        """
+        return self.anchor_time + (t_ns - self.anchor_ns) / 1e9
+
+    def time(self):
+        """Drop-in replacement for time.time()"""
+        return self.to_time(time.monotonic_ns())
+
+    def get_anchor(self):
+        return {"time": self.anchor_time, "monotonic_ns": self.anchor_ns}
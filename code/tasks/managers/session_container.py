@@ -0,0 +1,213 @@
+"""
+Session container: all streams of a session in one typed file, written at the end of the session next to the csv
+files. One group per stream with one dataset per column; string columns (trial_type, decision, choice, ...) are
+stored as small int codes with their categories as attribute, the meta data as (json encoded) attributes.
+HDF5 (h5py) is used if available, otherwise a NPZ file with "stream/column" keys.
+"""
+
+import json
+
+import numpy as np
+import pandas as pd
+from tasks.managers.utils.tone_cloud_log import (
+    load_tone_cloud_log,
+    tone_cloud_frequencies,
+)
+
+# stream name -> (csv suffix, header), header None: first csv row is the header, "trial": task dependent
+# tone clouds are taken from the binary tone cloud log, the csv entry is only used for sessions logged before it
+STREAMS = {
+    "trial_data": ("trial_data", "trial"),
+    "pump_data": ("pump_data", ["time", "pump_duration"]),
+    "tone_onset_data": (
+        "tone_onset_data",
+        ["trial_num", "tone_onset", "tone_onset_dac"],
+    ),
+    "tone_cloud_data": ("tone_cloud_data", "cloud"),
+    "rotary_data": ("rotary_data", None),
+    "camera_pulse_data": ("camera_pulse_data", None),
+    "sync_pulse_data": ("sync_pulse_data", None),
+}
+
+
+def import_h5py():
+    """
+    h5py is imported on first use, it is slow to import and only needed at the end of the session or when a
+    container is read
+    :return: h5py module, None if it is not installed (the container falls back to NPZ)
+    """
+    try:
+        import h5py
+    except ImportError:
+        return None
+    return h5py
+
+
+def get_container_fn(exp_dir, today):
+    """
+    :param exp_dir: Path
+    :param today: str
+    :return: container_fn: Path (h5 if h5py is installed, npz otherwise)
+    """
+    suffix = "h5" if import_h5py() is not None else "npz"
+    return exp_dir.joinpath(f"{today}_session.{suffix}")
+
+
+def find_container(exp_dir):
+    """Return the session container in exp_dir, or None if there is none (or it can't be read here)"""
+    for pattern in ("*_session.h5", "*_session.npz"):
+        for fn in exp_dir.glob(pattern):
+            if fn.suffix == ".npz" or import_h5py() is not None:
+                return fn
+    return None
+
+
+def read_stream_csv(fn, header):
+    if not fn.exists() or fn.stat().st_size == 0:
+        return None
+    if header is None:
+        return pd.read_csv(fn)
+    if header == "cloud":  # one row of tone frequencies per trial
+        return pd.read_csv(fn, header=None).add_prefix("tone_")
+    with open(fn) as f:  # header row, if the stream was logged with one
+        has_header = f.readline().rstrip("\n") == ",".join(header)
+    return pd.read_csv(fn, names=header, skiprows=int(has_header))
+
+
+def encode_columns(df):
+    """
+    Split a data frame into typed column arrays, string columns are encoded as int codes
+    :param df: pd.DataFrame
+    :return: columns: dict (column name -> np.array)
+    :return: categories: dict (column name -> list of str, for encoded columns)
+    """
+    columns, categories = {}, {}
+    for col in df.columns:
+        values = df[col]
+        if not pd.api.types.is_numeric_dtype(values):
+            codes, uniques = pd.factorize(values.astype(str))
+            dtype = np.int8 if len(uniques) < 128 else np.int32
+            columns[col] = codes.astype(dtype)
+            categories[col] = uniques.tolist()
+        else:
+            columns[col] = values.to_numpy()
+    return columns, categories
+
+
+def tone_cloud_frame(columns):
+    """Frequencies of the logged tone clouds, one row per cloud (columns as in the former csv log)"""
+    tone_idx = np.stack((columns["octave"], columns["pitch_idx"]), axis=1)
+    frequencies = tone_cloud_frequencies(tone_idx, columns["tones_arr"])
+    return pd.DataFrame(frequencies).add_prefix("tone_")
+
+
+def decode_columns(columns, categories):
+    df = pd.DataFrame(columns)
+    for col, uniques in categories.items():
+        labels = np.asarray(uniques, dtype=object)[df[col].to_numpy()]
+        df[col] = pd.Series(labels).astype(str)  # same string dtype as pd.read_csv
+    return df
+
+
+def write_session_container(exp_dir, today, trial_header, meta_data=None):
+    """
+    Collect the csv streams of a session into one container file
+    :param exp_dir: Path
+    :param today: str (date prefix of the session files)
+    :param trial_header: list (columns of the trial data, see DataIO.load_trial_header)
+    :param meta_data: dict (loaded from the session's meta-data.json if None)
+    :return: container_fn: Path
+    """
+    streams = {}
+    tone_cloud_fn = exp_dir.joinpath(f"{today}_tone_cloud_data.bin")
+    if tone_cloud_fn.exists():  # kept as uint8 indices, 2d datasets [clouds, num_tones]
+        tone_idx, tones_arr = load_tone_cloud_log(tone_cloud_fn)
+        streams["tone_cloud_data"] = (
+            {
+                "octave": tone_idx[:, 0],
+                "pitch_idx": tone_idx[:, 1],
+                "tones_arr": tones_arr,
+            },
+            {},
+        )
+    for name, (suffix, header) in STREAMS.items():
+        if name in streams:
+            continue
+        header = trial_header if header == "trial" else header
+        df = read_stream_csv(exp_dir.joinpath(f"{today}_{suffix}.csv"), header)
+        if df is not None:
+            streams[name] = encode_columns(df)
+    if meta_data is None:
+        meta_data = {}
+        for fn in exp_dir.glob("*_meta-data.json"):
+            with open(fn) as meta_file:
+                meta_data = json.load(meta_file)
+
+    container_fn = get_container_fn(exp_dir, today)
+    h5py = import_h5py()
+    if h5py is not None:
+        with h5py.File(container_fn, "w") as f:
+            for key, value in meta_data.items():
+                f.attrs[key] = json.dumps(value)
+            for name, (columns, categories) in streams.items():
+                group = f.create_group(name)
+                group.attrs["columns"] = json.dumps(list(columns))  # datasets are listed by name
+                for col, values in columns.items():
+                    dset = group.create_dataset(
+                        col, data=values, chunks=True, compression="gzip"
+                    )
+                    if col in categories:
+                        dset.attrs["categories"] = json.dumps(categories[col])
+    else:
+        arrays = {"meta_data": np.array(json.dumps(meta_data))}
+        for name, (columns, categories) in streams.items():
+            for col, values in columns.items():
+                arrays[f"{name}/{col}"] = values
+            arrays[f"{name}/__categories__"] = np.array(json.dumps(categories))
+        np.savez(container_fn, **arrays)
+    return container_fn
+
+
+def load_session_container(container_fn, streams=None):
+    """
+    Load a session container written by write_session_container
+    :param container_fn: Path
+    :param streams: list of stream names to load, all if None
+    :return: data: dict (stream name -> pd.DataFrame)
+    :return: meta_data: dict
+    """
+    data = {}
+    if container_fn.suffix == ".h5":
+        h5py = import_h5py()
+        with h5py.File(container_fn, "r") as f:
+            meta_data = {key: json.loads(value) for key, value in f.attrs.items()}
+            for name in f.keys():
+                if streams is not None and name not in streams:
+                    continue
+                columns, categories = {}, {}
+                for col in json.loads(f[name].attrs["columns"]):
+                    dset = f[name][col]
+                    columns[col] = dset[()]
+                    if "categories" in dset.attrs:
+                        categories[col] = json.loads(dset.attrs["categories"])
+                if "tones_arr" in columns:
+                    data[name] = tone_cloud_frame(columns)
+                else:
+                    data[name] = decode_columns(columns, categories)
+    else:
+        with np.load(container_fn) as f:
+            meta_data = json.loads(f["meta_data"].item())
+            grouped = {}
+            for key in f.files:
+                if "/" not in key:
+                    continue
+                name, col = key.split("/", 1)
+                if streams is None or name in streams:
+                    grouped.setdefault(name, {})[col] = f[key]
+            for name, columns in grouped.items():
+                categories = json.loads(columns.pop("__categories__").item())
+                if "tones_arr" in columns:
+                    data[name] = tone_cloud_frame(columns)
+                else:
+                    data[name] = decode_columns(columns, categories)
+    return data, meta_data
@@ -0,0 +1,54 @@
+import threading
+
+import numpy as np
+
+
+# Random number streams of a session, all derived from one seed that is stored in the meta data
+class SessionRNG:
+    TRIAL_STREAM = 0
+    CLOUD_STREAM = 1
+    TIMING_STREAM = 2
+
+    def __init__(self, seed=None):
+        """
+        Separate numpy Generators for the trial sequence (trial types, blocks, debiasing, stim strength), the
+        content of the tone clouds and timing (quiet window, ITI), so that replaying a session with the same seed
+        reproduces each stream independently of the others.
+
+        Clouds get one stream per (tgt_octave, stim_strength), keyed by the cloud type rather than by creation
+        order, so the n-th cloud of each type is the same no matter when the prefetcher generates it.
+
+        Parameters:
+            seed (int): Seed of the session, None draws a fresh one from the OS.
+        """
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.seed = self.seed_sequence.entropy
+        self.trial = self.spawn(self.TRIAL_STREAM)
+        self.timing = self.spawn(self.TIMING_STREAM)
+        self.cloud_streams = {}
+        self.lock = threading.Lock()  # clouds are generated by the prefetcher and the task thread
+
+    def spawn(self, *key):
+        return np.random.default_rng(
+            np.random.SeedSequence(self.seed, spawn_key=tuple(int(k) for k in key))
+        )
+
+    def cloud(self, tgt_octave, stim_strength):
+        """
+        Generator for the content of tone clouds of one type
+        :param tgt_octave: int
+        :param stim_strength: int
+        :return: rng: np.random.Generator
+        """
+        key = (tgt_octave, stim_strength)
+        with self.lock:
+            if key not in self.cloud_streams:
+                self.cloud_streams[key] = self.spawn(
+                    self.CLOUD_STREAM, tgt_octave, stim_strength
+                )
+            return self.cloud_streams[key]
+
+    @staticmethod
+    def choice(rng, options):
+        """Pick one element of options with rng, returned as is (no numpy scalar)"""
+        return options[rng.integers(len(options))]
@@ -1,20 +1,42 @@
-import random
-
 import numpy as np
-import pandas as pd
-from sklearn import preprocessing
+from tasks.managers.session_rng import SessionRNG
+from tasks.managers.utils.tone_cloud_log import ToneCloudLog
+
+
+class MinMaxNormalizer:
+    """
+    In-place min/max rescaling of a tone cloud to feature_range, same numerics as sklearn's
+    MinMaxScaler(feature_range).fit_transform without its import cost and input validation
+    """
+
+    def __init__(self, feature_range):
+        self.feature_range = feature_range
+
+    def fit_transform(self, X):
+        """
+        :param X: np.array float, rescaled in place
+        :return: X: np.array
+        """
+        data_min = X.min(axis=0)
+        data_range = X.max(axis=0) - data_min
+        data_range[data_range < 10 * np.finfo(data_range.dtype).eps] = 1.0  # constant
+        scale = (self.feature_range[1] - self.feature_range[0]) / data_range
+        X *= scale
+        X += self.feature_range[0] - data_min * scale
+        return X
 
 
 # Stimulus Manager class to manage tone clouds and stimulus-related methods
 class StimulusManager:
-    def __init__(self, task_prefs, droid_settings, data_io, exp_dir):
+    def __init__(self, task_prefs, droid_settings, data_io, exp_dir, session_rng=None):
         self.task_prefs = task_prefs
+        self.session_rng = session_rng if session_rng is not None else SessionRNG()
         self.droid_settings = droid_settings
         self.fs = droid_settings["base_params"]["tone_sampling_rate"]
         self.tone_fs = task_prefs["task_prefs"]["tone_fs"]
         self.tone_duration = self.task_prefs["task_prefs"]["tone_duration"]
         self.tone_amplitude = self.task_prefs["task_prefs"]["tone_amplitude"]
-        self.scaler = preprocessing.MinMaxScaler(
+        self.scaler = MinMaxNormalizer(
             feature_range=(
                 task_prefs["task_prefs"]["cloud_range"][0],
                 task_prefs["task_prefs"]["cloud_range"][1],
@@ -25,8 +47,24 @@ class StimulusManager:
         self.num_tones = int(
             self.cloud_duration * 100 - (self.tone_duration - 1 / self.tone_fs) * 100
         )
+        self.cloud_samples = int(self.fs * self.cloud_duration)
+        self.tone_step = int(
+            self.fs
+            * self.cloud_duration
+            / (((self.tone_duration - 1 / self.tone_fs) * 100) + self.num_tones)
+        )  # samples between onsets of consecutive tones in a cloud
+        self.tone_onsets = np.arange(self.num_tones) * self.tone_step
+        self.tone_tvec, self.tone_envelope = self.create_tone_envelope(
+            self.tone_duration
+        )
+        self.octave_cdfs = {}  # (tgt_octave, stim_strength) -> cumulative octave weights
+        self.tone_cache = {}  # (frequency, tone_duration, amplitude) -> tone, see get_tone
+        self.tone_waves = self.build_tone_waves()
         self.tone_cloud_fn = exp_dir.joinpath(
-            f"{data_io.path_manager.get_today()}_tone_cloud_data.csv"
+            f"{data_io.path_manager.get_today()}_tone_cloud_data.bin"
+        )
+        self.tone_cloud_log = ToneCloudLog(
+            self.tone_cloud_fn, self.tones_arr, self.num_tones
         )
         # todo option for tones vs tone clouds
 
@@ -40,12 +78,28 @@ class StimulusManager:
         frequency = 2 ** (int(pitch) / 12) * middle_frequency
         return frequency
 
-    def weighted_octave_choice(self, tgt_octave, stim_strength):
+    def octave_cdf(self, tgt_octave, stim_strength):
         """
-        Function to select tones for tone clouds from tgt_octave depending on stim strength
+        Cumulative octave weights for tone clouds of one type, computed once per type
         :param tgt_octave: int
         :param stim_strength: int
-        :return: oct_id: int
+        :return: cdf: np.array [3]
+        """
+        key = (tgt_octave, stim_strength)
+        if key not in self.octave_cdfs:
+            weights = self.octave_weights(tgt_octave, stim_strength)
+            cdf = np.cumsum(weights, dtype=float)
+            cdf /= cdf[-1]
+            cdf[-1] = 1.0  # uniform draws are < 1, so the last octave is never exceeded
+            self.octave_cdfs[key] = cdf
+        return self.octave_cdfs[key]
+
+    def octave_weights(self, tgt_octave, stim_strength):
+        """
+        Weights of the three octaves for tone clouds from tgt_octave depending on stim strength
+        :param tgt_octave: int
+        :param stim_strength: int
+        :return: weight_matrix: list
         """
         # stim_strength is the prob. for tone on tgt_octave, (100-stim_strength) is prob. for non tgt stimuli, so divided by two as there are two 'off-target octaves"
 
@@ -59,27 +113,38 @@ class StimulusManager:
                 weight_matrix[i] = int(
                     (100 - stim_strength) / 2
                 )  # inverse/2 for other two octaves
-        oct_id = random.choices(
-            population=[0, 1, 2], weights=weight_matrix
-        )  # draw oct. for current tone
-        return oct_id[0]
+        return weight_matrix
 
-    def create_tone(self, frequency, tone_duration, amplitude):
+    def sample_tone_indices(self, tgt_octave, stim_strength, n_clouds=None):
         """
-         Function to create tones; adapted from: https://github.com/int-brain-lab/iblrig/blob/master/iblrig/sound.py
-        --> using ramping of to avoid onset artefacts
-        :param fs: int
-        :param frequency:
-        :param tone_duration:
-        :param amplitude:
-        :return:
+        Draw octave ids and pitch indices for one or many tone clouds in one go. The clouds are drawn in the same
+        order from the stream of their type, so n_clouds at once give the same clouds as n_clouds single calls.
+        :param tgt_octave: int
+        :param stim_strength: int
+        :param n_clouds: int, number of clouds (a single cloud if None)
+        :return: tone_idx: np.array [2, num_tones] or [n_clouds, 2, num_tones] uint8 (octave ids, pitch indices)
         """
+        shape = (1 if n_clouds is None else n_clouds, 2, self.num_tones)
+        rng = self.session_rng.cloud(tgt_octave, stim_strength)
+        draws = rng.random(shape)  # [:, 0] picks the octave, [:, 1] the pitch within it
+        tone_idx = np.empty(shape, dtype=np.uint8)
+        tone_idx[:, 0] = np.searchsorted(
+            self.octave_cdf(tgt_octave, stim_strength), draws[:, 0], side="right"
+        )
+        tone_idx[:, 1] = draws[:, 1] * self.tones_arr.shape[1]  # truncated to the index
+        return tone_idx[0] if n_clouds is None else tone_idx
 
+    def create_tone_envelope(self, tone_duration):
+        """
+        Time vector and fade-in/out window for tones of tone_duration, shared by all tones of that duration
+        :param tone_duration: float
+        :return: tvec: np.array
+        :return: win: np.array
+        """
         fade = 0.1  # as percentage of tone_duration --> 10 %
         fade_duration = tone_duration * fade  # sec
         #
         tvec = np.linspace(0, tone_duration, int(tone_duration * self.fs))
-        tone = amplitude * np.sin(2 * np.pi * frequency * tvec)  # tone vec
         #
         len_fade = int(fade_duration * self.fs)
         fade_io = np.hanning(len_fade * 2)
@@ -88,11 +153,21 @@ class StimulusManager:
         win = np.ones(len(tvec))
         win[:len_fade] = fadein
         win[-len_fade:] = fadeout
-        #
+        return tvec, win
+
+    def create_tone(self, frequency, tone_duration, amplitude):
+        """
+         Function to create tones; adapted from: https://github.com/int-brain-lab/iblrig/blob/master/iblrig/sound.py
+        --> using ramping of to avoid onset artefacts
+        :param fs: int
+        :param frequency:
+        :param tone_duration:
+        :param amplitude:
+        :return:
+        """
+        tvec, win = self.create_tone_envelope(tone_duration)
+        tone = amplitude * np.sin(2 * np.pi * frequency * tvec)  # tone vec
         tone = tone * win
-        ttl = np.ones(len(tone)) * 0.99
-        one_ms = round(self.fs / 1000) * 10
-        ttl[one_ms:] = 0
         #
         if frequency == -1:
             tone = amplitude * np.random.rand(tone.size)
@@ -102,6 +177,19 @@ class StimulusManager:
         audio = audio.astype(np.int16)
         return audio
 
+    def create_tones(self, frequencies):
+        """
+        Batched version of create_tone for the tones of a cloud: all tones are synthesised in one pass with the
+        precomputed envelope, each row is identical to create_tone(frequency, tone_duration, tone_amplitude)
+        :param frequencies: list
+        :return: audio: np.array [len(frequencies), samples per tone]
+        """
+        frequencies = np.asarray(frequencies, dtype=float)[:, np.newaxis]
+        tones = self.tone_amplitude * np.sin(2 * np.pi * frequencies * self.tone_tvec)
+        tones *= self.tone_envelope
+        audio = tones * (2**15 - 1) / np.max(np.abs(tones), axis=1, keepdims=True)
+        return audio.astype(np.int16)
+
     def generate_tones(self):
         low_octave = np.linspace(
             self.task_prefs["task_prefs"]["low_octave"][0],
@@ -120,34 +208,84 @@ class StimulusManager:
         )
         return np.vstack([low_octave, middle_octave, high_octave])
 
-    def create_tone_cloud(self, tgt_octave, stim_strength):
-        tone_sequence_idx = [
-            random.choice(range(np.shape(self.tones_arr[1])[0]))
-            for _ in range(self.num_tones)
+    def get_tone(self, frequency, tone_duration, amplitude):
+        """
+        Get a single tone (e.g. the punishment sound, see punishment_sound in the task prefs), synthesised once per
+        (frequency, tone_duration, amplitude); white noise (frequency == -1) is drawn fresh every time. The tones of
+        the clouds are precomputed in tone_waves.
+        :param frequency: float
+        :param tone_duration: float
+        :param amplitude: float
+        :return: audio: np.array
+        """
+        if frequency == -1:
+            return self.create_tone(frequency, tone_duration, amplitude)
+        key = (frequency, tone_duration, amplitude)
+        if key not in self.tone_cache:
+            self.tone_cache[key] = self.create_tone(frequency, tone_duration, amplitude)
+        return self.tone_cache[key]
+
+    def build_tone_waves(self):
+        """
+        Synthesise all pitches of tones_arr once, the tone clouds are rendered from these waveforms
+        :return: tone_waves: np.array [octave, pitch, samples per tone]
+        """
+        frequencies = [
+            self.pitch_to_frequency(pitch) for pitch in self.tones_arr.ravel()
         ]
-        tone_sequence = np.array(
-            [
-                self.tones_arr[self.weighted_octave_choice(tgt_octave, stim_strength)][
-                    idx
-                ]
-                for idx in tone_sequence_idx
-            ]
-        )
-        tone_sequence = [self.pitch_to_frequency(pitch) for pitch in tone_sequence]
-        tone_cloud_duration = self.fs * self.cloud_duration
-        tone_cloud = np.zeros([int(tone_cloud_duration), len(tone_sequence)])
-        k = 0
-        pd.DataFrame(tone_sequence).T.to_csv(
-            self.tone_cloud_fn, index=False, header=False, mode="a"
+        tone_waves = self.create_tones(frequencies)
+        return tone_waves.reshape(*self.tones_arr.shape, -1)
+
+    def generate_tone_cloud(self, tgt_octave, stim_strength):
+        """
+        Generate a tone cloud without logging it, see create_tone_cloud
+        :param tgt_octave: int
+        :param stim_strength: int
+        :return: tone_cloud: np.array [samples, 2] int16, same signal on both channels
+        :return: tone_idx: np.array [2, num_tones] uint8 (octave ids and pitch indices into tones_arr)
+        """
+        tone_idx = self.sample_tone_indices(tgt_octave, stim_strength)
+        return self.render_tone_cloud(tone_idx)
+
+    def generate_tone_clouds(self, tgt_octave, stim_strength, n_clouds):
+        """
+        Pre-generate the tone clouds of one type for a whole session, without logging them
+        :param tgt_octave: int
+        :param stim_strength: int
+        :param n_clouds: int
+        :return: clouds: list of (tone_cloud, tone_idx), as returned by generate_tone_cloud
+        """
+        tone_idx = self.sample_tone_indices(tgt_octave, stim_strength, n_clouds)
+        return [self.render_tone_cloud(cloud_idx) for cloud_idx in tone_idx]
+
+    def render_tone_cloud(self, tone_idx):
+        """
+        Synthesise the tone cloud of drawn tone indices
+        :param tone_idx: np.array [2, num_tones] uint8 (octave ids and pitch indices into tones_arr)
+        :return: tone_cloud: np.array [samples, 2] int16, same signal on both channels
+        :return: tone_idx: np.array [2, num_tones] uint8
+        """
+        oct_ids, tone_sequence_idx = tone_idx
+        # overlap-add all tones into a 1-D buffer in one go, tone i starts at i * self.tone_step
+        tones = self.tone_waves[oct_ids, tone_sequence_idx]
+        sample_idx = self.tone_onsets[:, np.newaxis] + np.arange(tones.shape[1])
+        tone_cloud = np.bincount(
+            sample_idx.ravel(), weights=tones.ravel(), minlength=self.cloud_samples
         )
-        for i, tone in enumerate(tone_sequence):
-            tone_cloud[k : k + int(self.fs * self.tone_duration), i] = self.create_tone(tone, self.tone_duration,
-                                                                                        self.tone_amplitude
-            )
-            k += int(
-                tone_cloud_duration
-                / (((self.tone_duration - 1 / self.tone_fs) * 100) + len(tone_sequence))
-            )
-        tone_cloud = tone_cloud.sum(axis=1) // len(tone_sequence)
+        tone_cloud = tone_cloud // self.num_tones
         tone_cloud = tone_cloud.reshape(-1, 1)
-        return self.scaler.fit_transform(tone_cloud).astype(np.int16)
+        tone_cloud = self.scaler.fit_transform(tone_cloud).astype(np.int16)
+        # store the cloud interleaved for the two output channels, so the audio callback only copies
+        return np.repeat(tone_cloud, 2, axis=1), tone_idx
+
+    def log_tone_cloud(self, tone_idx):
+        """
+        Append a played tone cloud to the tone cloud log, see tone_cloud_log.tone_cloud_frequencies for frequencies
+        :param tone_idx: np.array [2, num_tones] uint8
+        """
+        self.tone_cloud_log.append(tone_idx)
+
+    def create_tone_cloud(self, tgt_octave, stim_strength):
+        tone_cloud, tone_idx = self.generate_tone_cloud(tgt_octave, stim_strength)
+        self.log_tone_cloud(tone_idx)
+        return tone_cloud
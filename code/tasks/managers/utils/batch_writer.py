@@ -0,0 +1,99 @@
+"""
+Batched csv writer for the recorder threads: (timestamp, value) samples are collected in preallocated numpy arrays
+and appended to the file in batches by a flusher thread, every flush_size samples, after flush_interval sec or on
+close. write() only buffers, so the GPIO callbacks and the camera trigger loop never wait for the disk.
+Each batch is written as complete rows and fsync'ed, so after a crash the file holds everything up to the last batch.
+"""
+
+import csv
+import os
+import threading
+
+import numpy as np
+
+
+class BatchWriter:
+    DTYPE = np.dtype([("timestamp", "f8"), ("value", "i8")])
+
+    def __init__(self, fn, header, flush_size=512, flush_interval=1.0):
+        """
+        Parameters:
+            fn (Path): Path of the csv file, it is created (or overwritten) with the header row.
+            header (list): Column names.
+            flush_size (int): Number of samples per batch.
+            flush_interval (float): Max. time in sec a sample is held in memory.
+        """
+        self.fn = fn
+        self.file = open(self.fn, mode="w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(header)  # CSV header
+        self.flush_size = flush_size
+        self.buffer = np.zeros(flush_size, dtype=self.DTYPE)
+        self.n = 0  # samples in buffer
+        self.full_buffers = []  # full buffers waiting for the flusher thread
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()  # write() may be called from GPIO callbacks and the recorder thread
+        self.io_lock = threading.Lock()  # one flush at a time
+        self.closed = False
+        self.wake = threading.Event()  # set when a buffer is full or on close
+        self.flush()
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def write(self, timestamp, value):
+        with self.lock:
+            self.buffer[self.n] = (timestamp, value)
+            self.n += 1
+            if self.n == len(self.buffer):
+                self._swap_buffer()
+
+    def write_many(self, timestamps, values):
+        """Append arrays of timestamps and values, e.g. drained encoder edges"""
+        with self.lock:
+            written = 0
+            while written < len(timestamps):
+                k = min(len(self.buffer) - self.n, len(timestamps) - written)
+                chunk = slice(self.n, self.n + k)
+                self.buffer["timestamp"][chunk] = timestamps[written : written + k]
+                self.buffer["value"][chunk] = values[written : written + k]
+                self.n += k
+                written += k
+                if self.n == len(self.buffer):
+                    self._swap_buffer()
+
+    def _swap_buffer(self):
+        # hand the full buffer over to the flusher thread, called with self.lock held
+        self.full_buffers.append(self.buffer)
+        self.buffer = np.empty(self.flush_size, dtype=self.DTYPE)
+        self.n = 0
+        self.wake.set()
+
+    def flush(self):
+        """Write all buffered samples to disk and fsync, the writers are only blocked while the buffers are taken."""
+        with self.io_lock:
+            with self.lock:
+                batches = self.full_buffers
+                batches.append(self.buffer[: self.n])
+                self.full_buffers = []
+                self.buffer = np.empty(self.flush_size, dtype=self.DTYPE)
+                self.n = 0
+            for batch in batches:
+                self.writer.writerows(batch.tolist())  # same row format as csv.writer on floats/ints
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def _flush_loop(self):
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Warning: writing {self.fn} failed: {e}")
+
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        self.flusher.join()
+        self.flush()
+        self.file.close()
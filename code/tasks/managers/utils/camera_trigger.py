@@ -0,0 +1,71 @@
+"""
+Camera trigger as a DMA-timed pigpio waveform: the pigpio daemon toggles the pin, so the frame period does not depend
+on the scheduling of the recorder thread. Edges are timestamped by the daemon (µs ticks) and passed to a callback.
+Needs the pigpio package and a running daemon (sudo pigpiod).
+"""
+
+import time
+
+try:
+    import pigpio
+except ImportError:  # optional, only needed for camera_trigger_backend "pigpio"
+    pigpio = None
+
+
+class PigpioTrigger:
+
+    def __init__(self, trigger_pin, rate, callback, clock=time.time):
+        """
+        Parameters:
+            trigger_pin (int): GPIO (BCM) number of the trigger output.
+            rate (float): Trigger rate in Hz, the period is rounded to µs.
+            callback (function): Called with (timestamp, level) for each edge, timestamp in seconds of clock.
+            clock (function): Clock the tick counter is anchored to, e.g. SessionClock.time.
+        """
+        if pigpio is None:
+            raise ImportError("pigpio is not installed, use camera_trigger_backend 'gpio'")
+        self.pi = pigpio.pi()
+        if not self.pi.connected:
+            raise RuntimeError("pigpio daemon not running, start it with 'sudo pigpiod'")
+        self.trigger_pin = trigger_pin
+        self.period_us = round(1e6 / rate)
+        self.high_us = self.period_us // 2
+        self.callback = callback
+        self.clock = clock
+        self.edge_callback = None
+        self.wave_id = None
+        self.last_tick = 0
+        self.elapsed_us = 0  # µs since start_time, accumulated from tick differences (ticks wrap every ~72 min)
+        self.start_time = 0
+
+    def start(self):
+        self.pi.set_mode(self.trigger_pin, pigpio.OUTPUT)
+        self.pi.write(self.trigger_pin, 0)
+        self.pi.wave_clear()
+        self.pi.wave_add_generic(
+            [
+                pigpio.pulse(1 << self.trigger_pin, 0, self.high_us),
+                pigpio.pulse(0, 1 << self.trigger_pin, self.period_us - self.high_us),
+            ]
+        )
+        self.wave_id = self.pi.wave_create()
+        self.last_tick = self.pi.get_current_tick()
+        self.start_time = self.clock()  # anchor of the tick clock
+        self.edge_callback = self.pi.callback(
+            self.trigger_pin, pigpio.EITHER_EDGE, self._edge
+        )
+        self.pi.wave_send_repeat(self.wave_id)
+
+    def _edge(self, gpio, level, tick):
+        self.elapsed_us += pigpio.tickDiff(self.last_tick, tick)
+        self.last_tick = tick
+        self.callback(self.start_time + self.elapsed_us / 1e6, level)
+
+    def stop(self):
+        self.pi.wave_tx_stop()
+        self.pi.write(self.trigger_pin, 0)
+        if self.edge_callback is not None:
+            self.edge_callback.cancel()
+        if self.wave_id is not None:
+            self.pi.wave_delete(self.wave_id)
+        self.pi.stop()
@@ -1,19 +1,48 @@
 # Class to monitor a rotary encoder and update a value.  You can either read the value when you need it, by calling getValue(), or
 # you can configure a callback which will be called whenever the value changes.
 # adapted from: https://github.com/nstansby/rpi-rotary-encoder-python
+# With edge_buffer_size > 0, every value change is also stored with its time.monotonic_ns() timestamp in a ring buffer,
+# which can be read in bulk with drainEdges().
+# watch() returns a threading.Event that is set from the GPIO callback as soon as the value leaves a given band.
 
+import threading
+import time
+
+import numpy as np
 import RPi.GPIO as GPIO
 
+# quarter step for each transition, indexed by (old_state << 2) | new_state with state = (left_pin << 1) | right_pin
+# turning right runs through 00 -> 01 -> 11 -> 10 -> 00, turning left the other way round
+ILLEGAL = 2  # both pins changed, i.e. at least one edge was missed
+TRANSITIONS = (
+    0, 1, -1, ILLEGAL,
+    -1, 0, ILLEGAL, 1,
+    1, ILLEGAL, 0, -1,
+    ILLEGAL, -1, 1, 0,
+)  # fmt: skip
+
 
 class Encoder:
 
-    def __init__(self, leftPin, rightPin, callback=None):
+    def __init__(self, leftPin, rightPin, callback=None, edge_buffer_size=0):
         self.leftPin = leftPin
         self.rightPin = rightPin
         self.value = 0
-        self.state = "00"
-        self.direction = None
+        self.state = 0  # resting position 00
+        self.steps = 0  # quarter steps, four per value count
+        self.direction = 0  # +1 right, -1 left, of the last legal transition
+        self.edge_count = 0  # number of GPIO edges handled
+        self.missed_count = 0  # edges after which the pin state did not change (bounce or missed edge)
+        self.illegal_count = 0  # transitions where both pins changed
         self.callback = callback
+        # ring buffer of (monotonic_ns, value) for every value change, only written by the GPIO callback
+        self.edge_buffer_size = edge_buffer_size
+        self.edge_times = np.zeros(edge_buffer_size, dtype=np.int64)
+        self.edge_values = np.zeros(edge_buffer_size, dtype=np.int64)
+        self.edge_write = 0  # total number of stored value changes
+        self.edge_read = 0  # total number of drained value changes
+        self.edge_overruns = 0  # value changes overwritten before they were drained
+        self.watches = ()  # (lower, upper, event), replaced as a whole so the callback can iterate without a lock
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(self.leftPin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
         GPIO.setup(self.rightPin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
@@ -23,52 +52,72 @@ class Encoder:
         )
 
     def transitionOccurred(self, channel):
-        p1 = GPIO.input(self.leftPin)
-        p2 = GPIO.input(self.rightPin)
-        newState = "{}{}".format(p1, p2)
+        newState = (GPIO.input(self.leftPin) << 1) | GPIO.input(self.rightPin)
+        self.edge_count += 1
 
-        if self.state == "00":  # Resting position
-            if newState == "01":  # Turned right 1
-                self.direction = "R"
-            elif newState == "10":  # Turned left 1
-                self.direction = "L"
+        delta = TRANSITIONS[(self.state << 2) | newState]
+        if delta == ILLEGAL:  # skipped an intermediate state, assume the wheel kept its direction
+            self.illegal_count += 1
+            delta = 2 * self.direction
+        elif delta:
+            self.direction = delta
+        elif newState == self.state:
+            self.missed_count += 1
+        self.steps += delta
+        self.state = newState
 
-        elif self.state == "01":  # R1 or L3 position
-            if newState == "11":  # Turned right 1
-                self.direction = "R"
-            elif newState == "00":  # Turned left 1
-                if self.direction == "L":
-                    self.value = self.value - 1
-                    if self.callback is not None:
-                        self.callback(self.value)
+        if newState == 0:  # resting position, a full turn step is complete
+            value = (self.steps + 2) >> 2  # round to the nearest full step, resyncs after missed edges
+            self.steps = value << 2
+            if value != self.value:
+                self.value = value
+                if self.edge_buffer_size:
+                    i = self.edge_write % self.edge_buffer_size
+                    self.edge_times[i] = time.monotonic_ns()
+                    self.edge_values[i] = value
+                    self.edge_write += 1
+                for lower, upper, event in self.watches:
+                    if not lower <= value <= upper:
+                        event.set()
+                if self.callback is not None:
+                    self.callback(self.value)
 
-        elif self.state == "10":  # R3 or L1
-            if newState == "11":  # Turned left 1
-                self.direction = "L"
-            elif newState == "00":  # Turned right 1
-                if self.direction == "R":
-                    self.value = self.value + 1
-                    if self.callback is not None:
-                        self.callback(self.value)
+    def getValue(self):
+        return self.value
 
-        else:  # self.state == "11"
-            if newState == "01":  # Turned left 1
-                self.direction = "L"
-            elif newState == "10":  # Turned right 1
-                self.direction = "R"
-            elif (
-                newState == "00"
-            ):  # Skipped an intermediate 01 or 10 state, but if we know direction then a turn is complete
-                if self.direction == "L":
-                    self.value = self.value - 1
-                    if self.callback is not None:
-                        self.callback(self.value)
-                elif self.direction == "R":
-                    self.value = self.value + 1
-                    if self.callback is not None:
-                        self.callback(self.value)
+    def watch(self, lower, upper):
+        """
+        Get an event that is set as soon as the value leaves [lower, upper], e.g. to wait for a wheel turn
+        :param lower: int
+        :param upper: int
+        :return: event: threading.Event (already set if the value is outside the band)
+        """
+        event = threading.Event()
+        self.watches = self.watches + ((lower, upper, event),)
+        if not lower <= self.value <= upper:
+            event.set()
+        return event
 
-        self.state = newState
+    def unwatch(self, event):
+        self.watches = tuple(w for w in self.watches if w[2] is not event)
 
-    def getValue(self):
-        return self.value
+    def drainEdges(self):
+        """
+        Return all value changes stored since the last call
+        :return: edge_times: np.array (time.monotonic_ns() timestamps)
+        :return: edge_values: np.array
+        """
+        edge_write = self.edge_write
+        edge_read = max(self.edge_read, edge_write - self.edge_buffer_size)
+        self.edge_overruns += edge_read - self.edge_read
+        idx = np.arange(edge_read, edge_write) % max(self.edge_buffer_size, 1)
+        self.edge_read = edge_write
+        return self.edge_times[idx], self.edge_values[idx]
+
+    def getStats(self):
+        return {
+            "edges": self.edge_count,
+            "missed": self.missed_count,
+            "illegal": self.illegal_count,
+            "edge_overruns": self.edge_overruns,
+        }
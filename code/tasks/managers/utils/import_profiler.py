@@ -0,0 +1,71 @@
+"""
+Import time profiler for the startup of run_training.py (--profile-startup), similar to python -X importtime but
+reported from within the script, so it covers the task module that is only imported after the first prompts.
+"""
+
+import builtins
+import sys
+import threading
+import time
+
+
+class ImportProfiler:
+    REPORT_LINES = 25  # slowest imports listed in the report
+
+    def __init__(self):
+        self.timings = {}  # module -> [self time, cumulative time] in sec, first import only
+        self.stack = []  # time spent in nested imports, one entry per open import
+        self.original_import = None
+        self.thread = None
+
+    def start(self):
+        self.original_import = builtins.__import__
+        self.thread = threading.current_thread()  # imports of other threads are not timed
+        builtins.__import__ = self._import
+
+    def stop(self):
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if threading.current_thread() is not self.thread:
+            return self.original_import(name, globals, locals, fromlist, level)
+        n_modules = len(sys.modules)
+        self.stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            if len(sys.modules) > n_modules:  # only imports that loaded new modules
+                module = self.resolve_name(name, globals, level)
+                timing = self.timings.setdefault(module, [0.0, 0.0])
+                timing[0] += elapsed - nested
+                timing[1] += elapsed
+
+    @staticmethod
+    def resolve_name(name, globals, level):
+        """Absolute module name of a (relative) import"""
+        if level == 0:
+            return name
+        package = (globals or {}).get("__package__") or ""
+        base = package.rsplit(".", level - 1)[0] if level > 1 else package
+        return f"{base}.{name}" if name else base
+
+    def report(self):
+        """
+        Stop profiling and print the slowest imports
+        :return: timings: dict (module -> [self time, cumulative time] in sec)
+        """
+        self.stop()
+        total = sum(self_time for self_time, _ in self.timings.values())
+        print(f"startup imports: {len(self.timings)} modules, {total:.3f} s")
+        print(f"{'self [ms]':>10} {'cumulative [ms]':>16}  module")
+        slowest = sorted(self.timings.items(), key=lambda item: -item[1][1])
+        for module, (self_time, cumulative) in slowest[: self.REPORT_LINES]:
+            print(f"{self_time * 1e3:10.1f} {cumulative * 1e3:16.1f}  {module}")
+        return self.timings
@@ -11,18 +11,51 @@ these functions:
   erf_psycho         - erf function from 0 to 1, with lapse rate
   erf_psycho_2gammas - erf function from 0 to 1, with two lapse rates
 Functions in the toolbox are:
-  mle_fit_psycho     - Maximumum likelihood fit of psychometric function
-  neg_likelihood     - Negative likelihood of a psychometric function
+  mle_fit_psycho      - Maximumum likelihood fit of psychometric function
+  mle_fit_psycho_fast - Bounded gradient fit of the erf models, batched multi-start
+  mle_fit_psycho_batch - Fit many datasets on a process pool, returns a table
+  bootstrap_psycho    - Parametric bootstrap confidence intervals of the erf models
+  neg_likelihood      - Negative likelihood of a psychometric function
 For more info, see:
   Examples           - Examples of use of psychofit toolbox
 Matteo Carandini, 2000-2015
 """
 
 import functools
+import math
+import os
 
 import numpy as np
-import scipy.optimize
-from scipy.special import erf
+
+FAST_MODELS = ("erf_psycho", "erf_psycho_2gammas")  # models with analytic gradients
+MIN_SLOPE = 1e-6  # lower bound of the slope in the bounded fits, erf((xx - bias) / slope)
+CANDIDATES_PER_FIT = 20  # random start candidates screened per fit in mle_fit_psycho_fast
+BOOTSTRAP_MAX_ITER = 100  # damped Gauss-Newton iterations of fit_erf_replicates
+BOOTSTRAP_TOL = 1e-9  # relative change of the negative log likelihood at convergence
+CHUNKS_PER_WORKER = 4  # default chunking of mle_fit_psycho_batch, datasets per task = n / (workers * 4)
+PARAMETER_NAMES = {
+    "weibull": ["alpha", "beta", "gamma"],
+    "weibull50": ["alpha", "beta", "gamma"],
+    "erf_psycho": ["bias", "slope", "gamma"],
+    "erf_psycho_2gammas": ["bias", "slope", "gamma1", "gamma2"],
+}
+
+
+_scipy_erf = None  # scipy.special.erf, imported by load_erf
+
+
+def load_erf():
+    """scipy.special.erf, imported on first use so importing psychofit doesn't slow down task startup"""
+    global _scipy_erf
+    if _scipy_erf is None:
+        from scipy.special import erf
+
+        _scipy_erf = erf
+    return _scipy_erf
+
+
+def erf(x):
+    return (_scipy_erf or load_erf())(x)
 
 
 def mle_fit_psycho(
@@ -85,6 +118,8 @@ def mle_fit_psycho(
     if parmax is None:
         parmax = np.array([np.max(data[0, :]), 10.0, *rep(0.4)])
 
+    from scipy.optimize import fmin  # imported on first fit, see load_erf
+
     # find the good values in pp (conditions that were effectively run)
     ii = np.isfinite(data[2, :])
 
@@ -97,7 +132,7 @@ def mle_fit_psycho(
         neg_likelihood, data=data[:, ii], P_model=P_model, parmin=parmin, parmax=parmax
     )
     for ifit in range(nfits):
-        pars[ifit, :] = scipy.optimize.fmin(f, parstart, disp=False)
+        pars[ifit, :] = fmin(f, parstart, disp=False)
         parstart = parmin + np.random.rand(parmin.size) * (parmax - parmin)
         likelihoods[ifit] = -neg_likelihood(
             pars[ifit, :], data[:, ii], P_model, parmin, parmax
@@ -109,6 +144,384 @@ def mle_fit_psycho(
     return pars[iBestFit, :], L
 
 
+def mle_fit_psycho_fast(
+    data,
+    P_model="erf_psycho_2gammas",
+    parstart=None,
+    parmin=None,
+    parmax=None,
+    nfits=5,
+    rng=None,
+):
+    """
+    Maximum likelihood fit of the erf psychometric functions with analytic gradients (L-BFGS-B within
+    [parmin, parmax]), same arguments and return values as mle_fit_psycho. The first fit starts from parstart, the
+    other nfits - 1 from the best of nfits * CANDIDATES_PER_FIT random candidates, which are evaluated in one
+    vectorised batch. Other models fall back to mle_fit_psycho.
+    Args:
+        data: 3 x n matrix (stim levels, number of trials, proportion rightward), see mle_fit_psycho
+        P_model: 'erf_psycho' or 'erf_psycho_2gammas' (DEFAULT)
+        parstart: Starting parameters [bias, slope, gamma(s)]. If None, the mle_fit_psycho defaults are used
+        parmin: Minimum parameter values. If None, the mle_fit_psycho defaults are used
+        parmax: Maximum parameter values. If None, the mle_fit_psycho defaults are used
+        nfits: The number of fits
+        rng: Seed or np.random.Generator for the random starts, None draws a fresh seed
+    Returns:
+        pars: The parameters from the best of the fits
+        L: The likelihood of the best fit
+    """
+    if P_model not in FAST_MODELS:
+        return mle_fit_psycho(data, P_model, parstart, parmin, parmax, nfits)
+    data, parstart, parmin, parmax = _erf_fit_setup(
+        data, P_model, parstart, parmin, parmax
+    )
+
+    from scipy.optimize import minimize  # imported on first fit, see load_erf
+
+    nll = ErfNegLikelihood(data, P_model)
+
+    rng = np.random.default_rng(rng)
+    candidates = parmin + rng.random((nfits * CANDIDATES_PER_FIT, parmin.size)) * (
+        parmax - parmin
+    )
+    best_candidates = np.argsort(nll.batch(candidates))[: nfits - 1]
+    starts = np.vstack((np.clip(parstart, parmin, parmax), candidates[best_candidates]))
+
+    bounds = list(zip(parmin, parmax))
+    pars, L = None, -np.inf
+    for start in starts:
+        result = minimize(nll, start, jac=True, method="L-BFGS-B", bounds=bounds)
+        if -result.fun > L:
+            pars, L = result.x, -result.fun
+    return pars, L
+
+
+def _erf_fit_setup(data, P_model, parstart, parmin, parmax):
+    """
+    Validate the data and fill in the default parameters of the erf fits (same defaults as mle_fit_psycho)
+    :return: data: np.array 3 x n float, conditions that were not run (nan) removed
+    :return: parstart, parmin, parmax: np.array, the slope bounded below by MIN_SLOPE
+    """
+    if isinstance(data, (list, tuple)):
+        data = np.array(data)
+    elif not isinstance(data, np.ndarray):
+        raise TypeError("data must be a list or numpy array")
+
+    if data.shape[0] != 3:
+        raise ValueError("data must be m by 3 matrix")
+
+    data = data.astype(float)
+    n_gammas = 2 if P_model.endswith("2gammas") else 1
+    if parstart is None:
+        parstart = np.array([np.mean(data[0, :]), 3.0, *[0.05] * n_gammas])
+    if parmin is None:
+        parmin = np.array([np.min(data[0, :]), 0.0, *[0.0] * n_gammas])
+    if parmax is None:
+        parmax = np.array([np.max(data[0, :]), 10.0, *[0.4] * n_gammas])
+    parmin = np.array(parmin, dtype=float)
+    parmin[1] = max(parmin[1], MIN_SLOPE)
+    parmax = np.array(parmax, dtype=float)
+
+    # find the good values in pp (conditions that were effectively run)
+    ii = np.isfinite(data[2, :])
+    return data[:, ii], np.asarray(parstart, dtype=float), parmin, parmax
+
+
+def bootstrap_psycho(
+    data,
+    P_model="erf_psycho_2gammas",
+    pars=None,
+    parstart=None,
+    parmin=None,
+    parmax=None,
+    nfits=5,
+    n_boot=1000,
+    alpha=0.05,
+    rng=None,
+):
+    """
+    Parametric bootstrap of the erf psychometric fits: the counts of all n_boot replicates are drawn from the
+    fitted curve in a single binomial draw and fitted together with fit_erf_replicates, warm started from the fit
+    to the data.
+    Args:
+        data: 3 x n matrix (stim levels, number of trials, proportion rightward), see mle_fit_psycho
+        P_model: 'erf_psycho' or 'erf_psycho_2gammas' (DEFAULT)
+        pars: Fit to the data, fitted with mle_fit_psycho_fast if None
+        parstart, parmin, parmax, nfits: As in mle_fit_psycho_fast
+        n_boot: Number of bootstrap replicates
+        alpha: The confidence intervals cover 1 - alpha (percentiles alpha / 2 and 1 - alpha / 2)
+        rng: Seed or np.random.Generator, None draws a fresh seed
+    Returns:
+        pars: The parameters fitted to the data
+        ci: 2 x n_pars matrix, lower and upper bound of the confidence interval of each parameter
+        boot_pars: n_boot x n_pars matrix, the parameters fitted to the replicates
+    """
+    if P_model not in FAST_MODELS:
+        raise ValueError(
+            'invalid model, options are "erf_psycho" and "erf_psycho_2gammas"'
+        )
+    rng = np.random.default_rng(rng)
+    if pars is None:
+        pars, _ = mle_fit_psycho_fast(
+            data, P_model, parstart, parmin, parmax, nfits, rng=rng
+        )
+    data, _, parmin, parmax = _erf_fit_setup(data, P_model, parstart, parmin, parmax)
+    xx, nn = data[0, :], np.rint(data[1, :]).astype(int)
+    probs = erf_psycho_2gammas(pars, xx) if len(pars) == 4 else erf_psycho(pars, xx)
+    pp_boot = rng.binomial(nn, probs, size=(n_boot, len(nn))) / np.maximum(nn, 1)
+    boot_pars, _ = fit_erf_replicates(xx, nn, pp_boot, pars, parmin, parmax)
+    ci = np.percentile(boot_pars, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return pars, ci, boot_pars
+
+
+def fit_erf_replicates(xx, nn, pp, parstart, parmin, parmax):
+    """
+    Fit an erf psychometric function to many replicates of the same stim levels at once with a damped, bounded
+    Gauss-Newton (Fisher scoring) iteration, vectorised over replicates. Meant for replicates close to a known fit
+    (bootstrap), which is used as start; the model is set by the number of parameters.
+    :param xx: np.array [n], stim levels
+    :param nn: np.array [n], number of trials per stim level
+    :param pp: np.array [n_rep, n], proportion rightward of every replicate
+    :param parstart: np.array [n_pars] or [n_rep, n_pars]
+    :param parmin: np.array [n_pars]
+    :param parmax: np.array [n_pars]
+    :return: pars: np.array [n_rep, n_pars]
+    :return: nll: np.array [n_rep], negative log likelihood of the fits
+    """
+    eps = np.finfo(float).eps
+    n_right, n_left = nn * pp, nn * (1 - pp)
+    n_pars = len(parmin)
+    pars = np.clip(
+        np.broadcast_to(parstart, (len(pp), n_pars)).astype(float), parmin, parmax
+    )
+
+    def evaluate(pars):
+        bias, slope, gamma1 = pars[:, [0]], pars[:, [1]], pars[:, [2]]
+        gamma2 = pars[:, [3]] if n_pars == 4 else gamma1
+        amplitude = 1 - gamma1 - gamma2
+        z = (xx - bias) / slope
+        phi = (erf(z) + 1) / 2
+        probs = np.clip(gamma1 + amplitude * phi, eps, 1 - eps)
+        nll = -(n_right * np.log(probs) + n_left * np.log(1 - probs)).sum(axis=1)
+        return nll, z, phi, probs, amplitude, slope
+
+    nll, z, phi, probs, amplitude, slope = evaluate(pars)
+    damping = np.full(len(pp), 1e-3)
+    for _ in range(BOOTSTRAP_MAX_ITER):
+        # jacobian of probs [n_rep, n, n_pars]
+        dp_dz = amplitude * np.exp(-(z**2)) / math.sqrt(math.pi)
+        jac = [-dp_dz / slope, -dp_dz * z / slope]
+        jac += [1 - phi, -phi] if n_pars == 4 else [1 - 2 * phi]
+        jac = np.stack(jac, axis=-1)
+        weights = nn / (probs * (1 - probs))
+        grad = np.einsum("rn,rnk->rk", (probs - pp) * weights, jac)
+        fisher = np.einsum("rn,rnk,rnl->rkl", weights, jac, jac)
+        diagonal = np.einsum("rkk->rk", fisher)
+        # Marquardt damping, bias and slope are nearly collinear if few trials fall between stim levels
+        fisher[:, np.arange(n_pars), np.arange(n_pars)] += (
+            damping[:, np.newaxis] * diagonal
+            + 1e-12 * diagonal.max(axis=1, keepdims=True)
+            + eps
+        )
+        step = np.linalg.solve(fisher, -grad[..., np.newaxis])[..., 0]
+        new_pars = np.clip(pars + step, parmin, parmax)
+        new_nll, new_z, new_phi, new_probs, new_amplitude, new_slope = evaluate(
+            new_pars
+        )
+        better = new_nll <= nll
+        converged = np.abs(nll - new_nll) <= BOOTSTRAP_TOL * np.abs(nll)
+        pars[better] = new_pars[better]
+        nll[better] = new_nll[better]
+        z[better], phi[better], probs[better] = (
+            new_z[better],
+            new_phi[better],
+            new_probs[better],
+        )
+        amplitude[better], slope[better] = new_amplitude[better], new_slope[better]
+        damping = np.where(better, np.maximum(damping / 10, 1e-9), damping * 10)
+        if np.all(converged | (damping > 1e10)):
+            break
+    return pars, nll
+
+
+def mle_fit_psycho_batch(
+    datasets,
+    P_model="erf_psycho_2gammas",
+    parstart=None,
+    parmin=None,
+    parmax=None,
+    nfits=5,
+    seed=None,
+    max_workers=None,
+    chunksize=None,
+):
+    """
+    Fit many datasets (animals, blocks, sessions) in parallel on a process pool. Every dataset gets its own seed
+    spawned from seed, so the results do not depend on the number of workers or the chunking, and max_workers=1
+    (serial, in this process) gives identical results.
+    Args:
+        datasets: list of 3 x n matrices, or dict of name -> 3 x n matrix
+        P_model: The psychometric function, see mle_fit_psycho. The erf models use mle_fit_psycho_fast
+        parstart, parmin, parmax, nfits: As in mle_fit_psycho, the same for all datasets
+        seed: int or np.random.SeedSequence, None draws a fresh one (stored in the attrs of the table)
+        max_workers: Number of processes, None uses all cores, 1 fits serially in this process
+        chunksize: Datasets sent to a process at once, None splits the datasets into CHUNKS_PER_WORKER chunks
+                   per worker
+    Returns:
+        fits: pd.DataFrame, one row per dataset with its name (or list index), the parameters and L
+    """
+    from concurrent.futures import ProcessPoolExecutor  # analysis only, see load_erf
+
+    import pandas as pd
+
+    if isinstance(datasets, dict):
+        names, datasets = list(datasets.keys()), list(datasets.values())
+    else:
+        names = list(range(len(datasets)))
+    seed_sequence = (
+        seed
+        if isinstance(seed, np.random.SeedSequence)
+        else np.random.SeedSequence(seed)
+    )
+    tasks = [
+        (data, P_model, parstart, parmin, parmax, nfits, dataset_seed)
+        for data, dataset_seed in zip(datasets, seed_sequence.spawn(len(datasets)))
+    ]
+
+    max_workers = max_workers if max_workers is not None else os.cpu_count() or 1
+    if max_workers <= 1 or len(tasks) <= 1:
+        results = [_fit_dataset(task) for task in tasks]
+    else:
+        if chunksize is None:
+            n_chunks = max_workers * CHUNKS_PER_WORKER
+            chunksize = max(1, math.ceil(len(tasks) / n_chunks))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_fit_dataset, tasks, chunksize=chunksize))
+
+    fits = pd.DataFrame(
+        [list(pars) + [L] for pars, L in results],
+        columns=PARAMETER_NAMES[P_model] + ["L"],
+    )
+    fits.insert(0, "dataset", names)
+    fits.attrs["seed"] = seed_sequence.entropy
+    return fits
+
+
+def _fit_dataset(task):
+    """Fit one dataset of mle_fit_psycho_batch, runs in the worker processes"""
+    data, P_model, parstart, parmin, parmax, nfits, seed = task
+    if P_model in FAST_MODELS:
+        rng = np.random.default_rng(seed)
+        return mle_fit_psycho_fast(
+            data, P_model, parstart, parmin, parmax, nfits, rng=rng
+        )
+    # mle_fit_psycho draws its random starts from the global numpy state, seed it for this fit only
+    state = np.random.get_state()
+    np.random.seed(seed.generate_state(1))
+    try:
+        return mle_fit_psycho(data, P_model, parstart, parmin, parmax, nfits)
+    finally:
+        np.random.set_state(state)
+
+
+class ErfNegLikelihood:
+    """
+    Negative log likelihood of erf_psycho / erf_psycho_2gammas and its gradient, the likelihood of neg_likelihood
+    with the probabilities clipped to [eps, 1 - eps]. The data are converted once and the intermediate arrays are
+    preallocated, so evaluations during a fit do not allocate (apart from the returned gradient).
+    """
+
+    EPS = np.finfo(float).eps
+
+    def __init__(self, data, P_model="erf_psycho_2gammas"):
+        if P_model not in FAST_MODELS:
+            raise ValueError(
+                'invalid model, options are "erf_psycho" and "erf_psycho_2gammas"'
+            )
+        self.erf = load_erf()
+        self.two_gammas = P_model == "erf_psycho_2gammas"
+        self.xx = np.ascontiguousarray(data[0, :], dtype=float)
+        nn = np.asarray(data[1, :], dtype=float)
+        pp = np.asarray(data[2, :], dtype=float)
+        self.n_right = nn * pp  # weights of log(p) and log(1 - p)
+        self.n_left = nn * (1 - pp)
+        self.z = np.empty_like(self.xx)
+        self.phi = np.empty_like(self.xx)
+        self.probs = np.empty_like(self.xx)
+        self.dl_dp = np.empty_like(self.xx)
+        self.buffer = np.empty_like(self.xx)
+        self.grad = np.empty(4 if self.two_gammas else 3)
+
+    def __call__(self, pars):
+        """
+        :param pars: np.array [bias, slope, gamma(s)]
+        :return: nll: float
+        :return: grad: np.array, gradient of nll with respect to pars
+        """
+        bias, slope, gamma1 = pars[0], pars[1], pars[2]
+        gamma2 = pars[3] if self.two_gammas else gamma1
+        amplitude = 1 - gamma1 - gamma2
+        z, phi, probs, dl_dp, buffer = (
+            self.z,
+            self.phi,
+            self.probs,
+            self.dl_dp,
+            self.buffer,
+        )
+
+        # probs = gamma1 + amplitude * (erf(z) + 1) / 2, z = (xx - bias) / slope
+        np.subtract(self.xx, bias, out=z)
+        z /= slope
+        self.erf(z, out=phi)
+        phi += 1
+        phi *= 0.5
+        np.multiply(phi, amplitude, out=probs)
+        probs += gamma1
+        np.clip(probs, self.EPS, 1 - self.EPS, out=probs)
+
+        np.log(probs, out=buffer)
+        nll = -np.dot(self.n_right, buffer)
+        np.subtract(1, probs, out=buffer)
+        np.log(buffer, out=buffer)
+        nll -= np.dot(self.n_left, buffer)
+
+        # d nll / d probs = n_left / (1 - probs) - n_right / probs
+        np.subtract(1, probs, out=buffer)
+        np.divide(self.n_left, buffer, out=dl_dp)
+        np.divide(self.n_right, probs, out=buffer)
+        dl_dp -= buffer
+        # d nll / d z = dl_dp * amplitude * exp(-z**2) / sqrt(pi)
+        np.square(z, out=buffer)
+        np.negative(buffer, out=buffer)
+        np.exp(buffer, out=buffer)
+        buffer *= amplitude / math.sqrt(math.pi)
+        buffer *= dl_dp
+
+        grad = self.grad
+        grad[0] = -buffer.sum() / slope
+        grad[1] = -np.dot(buffer, z) / slope
+        dl_dp_phi = np.dot(dl_dp, phi)
+        if self.two_gammas:
+            grad[2] = dl_dp.sum() - dl_dp_phi
+            grad[3] = -dl_dp_phi
+        else:
+            grad[2] = dl_dp.sum() - 2 * dl_dp_phi
+        return nll, grad.copy()  # the optimiser keeps previous gradients
+
+    def batch(self, pars):
+        """
+        Negative log likelihood of many parameter sets at once
+        :param pars: np.array [n_sets, n_pars]
+        :return: nll: np.array [n_sets]
+        """
+        pars = np.atleast_2d(pars)
+        gamma1 = pars[:, [2]]
+        gamma2 = pars[:, [3]] if self.two_gammas else gamma1
+        phi = (self.erf((self.xx - pars[:, [0]]) / pars[:, [1]]) + 1) / 2
+        probs = np.clip(gamma1 + (1 - gamma1 - gamma2) * phi, self.EPS, 1 - self.EPS)
+        return -(np.log(probs) @ self.n_right + np.log(1 - probs) @ self.n_left)
+
+
 def neg_likelihood(pars, data, P_model="weibull", parmin=None, parmax=None):
     """
     Negative likelihood of a psychometric function.
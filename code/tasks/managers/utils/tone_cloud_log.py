@@ -0,0 +1,93 @@
+"""
+Compact log of the played tone clouds: every cloud is appended as one fixed-size record of uint8 octave ids
+followed by uint8 pitch indices into tones_arr ([2, num_tones] bytes). A json sidecar next to the .bin file holds
+num_tones and tones_arr, so the frequencies can be restored without the task prefs of the session.
+"""
+
+import json
+import os
+
+import numpy as np
+
+MIDDLE_C_FREQUENCY = 261.625565  # middle C == C5, see StimulusManager.pitch_to_frequency
+
+
+class ToneCloudLog:
+
+    def __init__(self, fn, tones_arr, num_tones):
+        """
+        Parameters:
+            fn (Path): Path of the .bin file, the sidecar is written to fn.with_suffix(".json").
+            tones_arr (np.array): [octave, pitch] pitches the indices refer to.
+            num_tones (int): Number of tones per cloud.
+        """
+        self.fn = fn
+        self.num_tones = num_tones
+        with open(fn.with_suffix(".json"), "w") as f:
+            json.dump(
+                {
+                    "num_tones": num_tones,
+                    "record": ["octave", "pitch_idx"],
+                    "dtype": "uint8",
+                    "tones_arr": np.asarray(tones_arr).tolist(),
+                },
+                f,
+                indent=4,
+            )
+        self.file = open(fn, "ab")
+
+    def append(self, tone_idx):
+        """
+        Append one cloud; a record is written with a single call, so a crash can only cut off the last record
+        :param tone_idx: np.array [2, num_tones] uint8 (octave ids, pitch indices)
+        """
+        self.file.write(np.ascontiguousarray(tone_idx, dtype=np.uint8).tobytes())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load_tone_cloud_log(fn):
+    """
+    Load a tone cloud log, an incomplete last record is dropped
+    :param fn: Path (.bin file)
+    :return: tone_idx: np.array [clouds, 2, num_tones] uint8
+    :return: tones_arr: np.array [octave, pitch]
+    """
+    with open(fn.with_suffix(".json")) as f:
+        sidecar = json.load(f)
+    record_size = 2 * sidecar["num_tones"]
+    raw = np.fromfile(fn, dtype=np.uint8)
+    n_clouds = len(raw) // record_size
+    tone_idx = raw[: n_clouds * record_size].reshape(n_clouds, 2, sidecar["num_tones"])
+    return tone_idx, np.array(sidecar["tones_arr"])
+
+
+def tone_cloud_frequencies(tone_idx, tones_arr):
+    """
+    Convert logged tone clouds back to frequencies, same values as StimulusManager.pitch_to_frequency
+    :param tone_idx: np.array [clouds, 2, num_tones] (octave ids, pitch indices)
+    :param tones_arr: np.array [octave, pitch]
+    :return: frequencies: np.array [clouds, num_tones]
+    """
+    # python float power per pitch (not np.power), bit-identical to pitch_to_frequency
+    frequency_table = np.array(
+        [[2 ** (int(pitch) / 12) * MIDDLE_C_FREQUENCY for pitch in row] for row in tones_arr]
+    )
+    return frequency_table[tone_idx[:, 0], tone_idx[:, 1]]
+
+
+def convert_tone_cloud_log(fn, csv_fn=None):
+    """
+    Write a tone cloud log as csv with one row of frequencies per cloud (the former tone_cloud_data.csv format)
+    :param fn: Path (.bin file)
+    :param csv_fn: Path, defaults to fn with .csv suffix
+    :return: csv_fn: Path
+    """
+    csv_fn = csv_fn if csv_fn is not None else fn.with_suffix(".csv")
+    frequencies = tone_cloud_frequencies(*load_tone_cloud_log(fn))
+    with open(csv_fn, "w") as f:
+        for row in frequencies.tolist():
+            f.write(",".join(repr(freq) for freq in row) + os.linesep)
+    return csv_fn
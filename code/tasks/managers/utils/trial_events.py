@@ -0,0 +1,62 @@
+"""
+Reduce the event log of a session (trial_data.csv, one row per logged event) to one row per trial. Used by the
+stage checker, the bias correction and the tutorial data loader.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def reduce_trial_events(trial_data, trial_data_header, right_trials=None):
+    """
+    A trial spans the rows from its trial_start row to the row before the next trial start. The trial_num column
+    lags on the trial_start row (it is logged before the trial counter is increased), so the rows are assigned to
+    trials by the running count of trial_start rows.
+    :param trial_data: pd.DataFrame, event log with trial_data_header as columns
+    :param trial_data_header: list
+    :param right_trials: str, 2afc trial type of right turns; if given, stim_strength is converted to the % of
+                         tones of that trial type
+    :return: trial_times: pd.DataFrame, one row per trial:
+        index: row of the trial start in the log
+        time, trial_num, trial_start: from the trial_start row
+        trial_type, stim_strength, ...: from the last row of the trial
+        tone_onset: time of the tone onset row
+        reward_time: time of the second last row of the trial, 0 for incorrect and no_response trials
+        decision_time: time of the row after the tone onset row
+    """
+    trial_data = trial_data.reset_index(drop=True)
+    is_start = (trial_data["trial_start"] == 1).to_numpy()
+    start_idx = np.flatnonzero(is_start)
+    end_idx = np.append(start_idx[1:], len(trial_data)) - 1  # last row of every trial
+    trial_id = pd.Series(np.cumsum(is_start) - 1)  # -1: rows before the first trial
+
+    trial_times = trial_data.iloc[start_idx][trial_data_header[0:3]].reset_index()
+    trial_info = trial_data.iloc[end_idx][trial_data_header[3:]].reset_index(drop=True)
+    trial_times = pd.concat([trial_times, trial_info], axis=1)
+    if right_trials is not None:
+        stim_strength = trial_times["stim_strength"].astype(int)
+        trial_times["stim_strength"] = stim_strength.where(
+            trial_times["trial_type"] == right_trials, 100 - stim_strength
+        )
+
+    # first tone onset row of every trial, and the (decision) row that follows it
+    is_tone = (trial_data["tone_onset"] == 1) & (trial_id >= 0)
+    tone_rows = trial_id[is_tone]
+    trial_times["tone_onset"] = (
+        trial_data["time"][is_tone].groupby(tone_rows).first().reindex(trial_times.index)
+    )
+    before_end = trial_data.iloc[end_idx - 1]
+    no_reward = (before_end["choice"] == "incorrect") | (
+        before_end["decision"] == "no_response"
+    )
+    trial_times["reward_time"] = np.where(
+        no_reward.to_numpy(), 0, before_end["time"].to_numpy()
+    )
+    trial_times["decision_time"] = (
+        trial_data["time"]
+        .shift(-1)[is_tone]
+        .groupby(tone_rows)
+        .first()
+        .reindex(trial_times.index)
+    )
+    return trial_times
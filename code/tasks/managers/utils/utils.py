@@ -7,9 +7,6 @@ FJ
 import math
 import os
 
-import asciichartpy as acp
-import pandas as pd
-
 # %% general/random functions
 
 
@@ -47,6 +44,9 @@ def plot_behavior_terminal(data_io, exp_dir):
     :param exp_dir: Path
     :param trial_data_header: list
     """
+    import asciichartpy as acp  # only needed at the end of the session, not at startup
+    import pandas as pd
+
     # load the trial data
     trial_data_file = exp_dir.joinpath(
         f"{data_io.path_manager.get_today()}_trial_data.csv"
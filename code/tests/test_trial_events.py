@@ -0,0 +1,164 @@
+"""
+reduce_trial_events against the former row-by-row StageChecker._create_trial_file, on the tutorial detection session
+and on simulated 2afc sessions. Run from the repository root with: python -m pytest -q code/tests
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+CODE_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(CODE_DIR))
+
+from tasks.managers.utils.trial_events import reduce_trial_events  # noqa: E402
+
+TUTORIAL_SESSION = CODE_DIR.parent.joinpath(
+    "tutorial", "detection", "det-001", "20250113", "151834", "20250113_trial_data.csv"
+)
+HEADER_2AFC = [
+    "time",
+    "trial_num",
+    "trial_start",
+    "trial_type",
+    "stim_strength",
+    "tone_onset",
+    "decision",
+    "choice",
+    "reward_time",
+    "inter_trial_interval",
+    "block",
+]
+HEADER_DETECTION = [
+    "time",
+    "trial_num",
+    "trial_start",
+    "trial_type",
+    "tone_onset",
+    "decision",
+    "choice",
+    "left_right",
+    "reward_time",
+    "inter_trial_interval",
+]
+RIGHT_TRIALS = "high"
+
+
+def create_trial_file_reference(trial_data, trial_data_header, right_trials=None):
+    # StageChecker._create_trial_file before it was vectorised
+    trial_times = (
+        trial_data[trial_data["trial_start"] == 1][trial_data_header[0:3]]
+        .reset_index()
+        .copy()
+    )
+    idx = trial_data.index[trial_data["trial_start"] == 1].tolist()
+    idx = idx[1:]
+    idx.append(len(trial_data))
+    idx = [i - 1 for i in idx]
+    dummy_df = (
+        trial_data.iloc[idx][trial_data_header[3:]].reset_index(drop=True).copy()
+    )
+    trial_times = pd.concat([trial_times, dummy_df], axis=1)
+    if right_trials is not None:
+        trial_times["stim_strength"] = [
+            int(stim) for stim in trial_times["stim_strength"]
+        ]
+        left = trial_times["trial_type"] != right_trials
+        trial_times.loc[left, "stim_strength"] = trial_times.loc[
+            left, "stim_strength"
+        ].apply(lambda x: 100 - x)
+    trial_times["tone_onset"] = (
+        trial_data[trial_data["tone_onset"] == 1]["time"]
+        .reset_index(drop=True)
+        .copy()
+    )
+    time_reward = []
+    for i in [id - 1 for id in idx]:
+        if (
+            trial_data["choice"][i] == "incorrect"
+            or trial_data["decision"][i] == "no_response"
+        ):
+            time_reward.append(0)
+        else:
+            time_reward.append(trial_data["time"][i])
+    if trial_data["reward_time"].iloc[-2] == 0:
+        time_reward.append(0)
+    else:
+        time_reward.append(trial_data["time"].iloc[-2])
+    trial_times["reward_time"] = pd.DataFrame(time_reward)
+    decision_idx = trial_data[trial_data["tone_onset"] == 1].index + 1
+    trial_times["decision_time"] = (
+        trial_data["time"][decision_idx].reset_index(drop=True).copy()
+    )
+    return trial_times
+
+
+def simulate_2afc_log(n_trials, rng, tmp_path, stop_in_quiet_window=False):
+    """
+    Event log as written by Auditory2AFC: trial start, tone onset, decision, reward (correct trials only) and ITI
+    row per trial. With stop_in_quiet_window the session ends with a trial start row, i.e. it was stopped before the
+    tone of the last trial.
+    """
+    rows = []
+    t, trial_num = 1000.0, 0
+    trial_type, stim, decision, choice, iti, block = "high", False, None, None, 0, 0
+
+    def log(trial_start=0, tone_onset=0, reward=0):
+        rows.append(
+            [t, trial_num, trial_start, trial_type, stim, tone_onset, decision, choice]
+            + [reward, iti, block]
+        )
+
+    for _ in range(n_trials):
+        log(trial_start=1)
+        t += rng.uniform(0.5, 2)
+        trial_num += 1
+        trial_type = rng.choice(["high", "low"])
+        stim = int(rng.choice([100, 85, 70, 60]))
+        block = int(rng.choice([-1, 0, 1]))
+        log(tone_onset=1)
+        t += rng.uniform(0.1, 1)
+        decision = rng.choice(["right", "left", "no_response"])
+        if decision == "no_response":
+            choice = "undecided"
+        else:
+            choice = rng.choice(["correct", "incorrect"])
+        log()
+        if choice == "correct":
+            t += 0.01
+            log(reward=1)
+        iti = 1.5
+        t += iti
+        log()
+    if stop_in_quiet_window:
+        log(trial_start=1)
+    # round trip through the csv file like the stage checker
+    fn = tmp_path.joinpath("trial_data.csv")
+    pd.DataFrame(rows).to_csv(fn, header=False, index=False)
+    trial_data = pd.read_csv(fn, names=HEADER_2AFC)
+    trial_data["time"] -= trial_data["time"][0]
+    return trial_data
+
+
+def assert_same_trials(trial_data, header, right_trials=None):
+    expected = create_trial_file_reference(trial_data.copy(), header, right_trials)
+    result = reduce_trial_events(trial_data.copy(), header, right_trials)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_tutorial_detection_session():
+    trial_data = pd.read_csv(TUTORIAL_SESSION, names=HEADER_DETECTION)
+    trial_data["time"] -= trial_data["time"][0]
+    assert_same_trials(trial_data, HEADER_DETECTION)
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("stop_in_quiet_window", [False, True])
+def test_simulated_2afc_session(seed, stop_in_quiet_window, tmp_path):
+    rng = np.random.default_rng(seed)
+    trial_data = simulate_2afc_log(
+        int(rng.integers(2, 60)), rng, tmp_path, stop_in_quiet_window
+    )
+    assert_same_trials(trial_data, HEADER_2AFC, RIGHT_TRIALS)
@@ -1,7 +1,11 @@
-import os, json
+import os, json, sys
 import pandas as pd
 import numpy as np
 
+# the event-to-trial reduction is shared with the task code
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+from tasks.managers.utils.trial_events import reduce_trial_events
+
 
 class BehaviorData:
     def __init__(self, data_directory) -> None:
@@ -165,6 +169,7 @@ class TrialDataWrapper:
                 os.path.dirname(
                     os.path.dirname(session_wrapper._session_directory)))]
             self.all = pd.read_csv(path_trial_data, names=trial_header)
+            self.trial_header = trial_header
         else:
             print('No trial data found for', session_wrapper.session)
 
@@ -182,6 +187,14 @@ class TrialDataWrapper:
         else:
             pass
 
+    @property
+    def trials(self):  # one row per trial (start, tone onset, decision, reward times and outcome)
+        if hasattr(self, 'trials_table'):
+            return self.trials_table
+        else:
+            self.trials_table = reduce_trial_events(self.all, self.trial_header)
+            return self.trials_table
+
     # decision options
     @property
     def moved_wheel(self):  # detection outcome (1/2)